@@ -1,24 +1,74 @@
-from typing import List
+from typing import List, AsyncIterator, Callable, Iterator, Optional, Tuple
 
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, status, Query
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, status, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
 
 from app.schemas import AddDocumentsRequest
-from utils import pdf_reader
+from utils import embedding, pdf_reader
 from utils.all_text_analyzer import AllTextAnalyzer
 from utils.content_analyzer import ContentAnalyzer
 from utils.image_analyzer import ImageAnalyzer
 from utils.rag_analyzer import rag_analyzer
-from core.config import get_llm_models_list, get_vlm_models_list
-import os
+from utils.inference_gateway import inference_gateway
+from utils.result_cache import result_cache, artifact_cache, caption_cache, summary_cache, make_key
+from utils.llm_cache import llm_cache
+from utils.local_backend import local_backend
+from core.config import (get_llm_models_list, get_vlm_models_list, get_render_dpi, get_render_max_dimension,
+                         get_warmup_on_startup)
 import asyncio
+import codecs
+import json
+import time
 
 router = APIRouter(prefix="/api", tags=["Анализатор презентаций"])
 
+# PDF читается потоком из тела запроса (pdf_reader.ingest_request), а не через UploadFile,
+# поэтому поле с файлом описывается для OpenAPI вручную
+PDF_UPLOAD_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["file"],
+            "properties": {"file": {"type": "string", "format": "binary",
+                                    "description": "Загрузите презентацию в формате PDF"}}
+        }}}
+    }
+}
+
+
+# состояние фонового прогрева: модель эмбеддингов и подключение к Qdrant
+_warmup = {"state": "disabled", "errors": {}}
+_warmup_task = None
+
 
 @router.on_event("startup")
 async def startup_event():
-    rag_analyzer.initialize()
+    global _warmup_task
+    await inference_gateway.start()
+    # тяжёлые компоненты загружаются в фоне: сервис отвечает сразу после старта,
+    # а то, что не успело прогреться, загрузится при первом обращении
+    if get_warmup_on_startup():
+        _warmup["state"] = "running"
+        _warmup_task = asyncio.create_task(_warm_up())
+
+@router.on_event("shutdown")
+async def shutdown_event():
+    if _warmup_task is not None:
+        _warmup_task.cancel()
+    await inference_gateway.close()
+    pdf_reader.shutdown_process_pool()
+
+async def _warm_up() -> None:
+    for name, load in (("embedder", embedding.get_embedder), ("rag", rag_analyzer.initialize)):
+        try:
+            await asyncio.to_thread(load)
+        except Exception as e:
+            print(f"[warmup] {name} failed: {e}")
+            _warmup["errors"][name] = str(e)
+    _warmup["state"] = "done"
 
 def _filter_slides_by_flags(slides_text, first_slide: bool, last_slide: bool):
     if not slides_text:
@@ -36,6 +86,168 @@ def _filter_slides_by_flags(slides_text, first_slide: bool, last_slide: bool):
     included = [s for s in slides_text if s['slide_number'] not in excluded]
     return included, sorted(list(excluded))
 
+def _build_full_text(included_slides) -> str:
+    full_text_blocks = []
+    for slide in included_slides:
+        idx = slide.get("slide_number", "?")
+        text = slide.get("text", "").strip()
+        full_text_blocks.append(f"--- SLIDE {idx} ---\n{text}")
+
+    return "\n\n".join(full_text_blocks)
+
+async def _apply_rag(full_text: str, use_rag: bool, user_context: str):
+    if not (use_rag and user_context):
+        return full_text, "rag-система не использовалась"
+    # идёт фоновый прогрев — дожидаемся его, а не загружаем модель эмбеддингов второй раз;
+    # shield: отмена запроса не должна отменять общий для процесса прогрев
+    if _warmup_task is not None and not _warmup_task.done():
+        await asyncio.shield(_warmup_task)
+    # загрузка эмбеддера, эмбеддинг запроса и поиск в хранилище блокирующие — в потоке
+    return await asyncio.to_thread(_apply_rag_sync, full_text, use_rag, user_context)
+
+def _apply_rag_sync(full_text: str, use_rag: bool, user_context: str):
+    rag_output = "rag-система не использовалась"
+
+    if use_rag and user_context:
+        if not rag_analyzer.initialized:
+            rag_analyzer.initialize()
+        relevant_docs = rag_analyzer.query(user_context, top_k=3)
+        context_text = "\n".join([d["text"] for d in relevant_docs])
+        prompt_with_context = f"{context_text}\n\n{full_text}"
+        rag_output = rag_analyzer.query(prompt_with_context)
+    else:
+        prompt_with_context = full_text
+
+    return prompt_with_context, rag_output
+
+def _is_cacheable(report: dict) -> bool:
+    # fallback-ответы и отчёты, где часть блоков не удалась (сбой модели), не кешируем,
+    # чтобы повторный запрос мог пройти успешно
+    return (isinstance(report, dict) and report.get("final_verdict") != "Fallback"
+            and not report.get("partial"))
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _event_stream(events: AsyncIterator[str], background: Optional[BackgroundTask] = None) -> StreamingResponse:
+    # X-Accel-Buffering: nginx не должен копить события в буфере
+    return StreamingResponse(events, media_type="text/event-stream", background=background,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def _single_report_stream(response: dict) -> AsyncIterator[str]:
+    yield _sse("report", response)
+
+def _structure_cache_key(sha256: str, model_name: str, first_slide: bool, last_slide: bool,
+                         max_tokens: int, temperature: float) -> str:
+    return make_key(sha256, 'structure', model_name=model_name, first_slide=first_slide,
+                    last_slide=last_slide, max_tokens=max_tokens, temperature=temperature)
+
+def _content_cache_key(sha256: str, model_name: str, first_slide: bool, last_slide: bool,
+                       max_tokens: int, temperature: float) -> str:
+    return make_key(sha256, 'content', model_name=model_name, first_slide=first_slide,
+                    last_slide=last_slide, max_tokens=max_tokens, temperature=temperature)
+
+def _visual_cache_key(sha256: str, model_name: str) -> str:
+    return make_key(sha256, 'visual', model_name=model_name,
+                    dpi=get_render_dpi(), max_dimension=get_render_max_dimension())
+
+def _find_model(models: List[dict], model_id: int) -> str:
+    model_name = None
+    for model in models:
+        if model.get('id') == model_id: model_name = model.get('model_name')
+    if not model_name:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Модель не найдена')
+    return model_name
+
+async def _prepare_upload(request: Request, model_name: str, cache_key: Callable[[str, str], str],
+                          use_cache: bool = True) -> Tuple[pdf_reader.IngestedPdf, str, Optional[dict]]:
+    """
+    Приём PDF и проверка кеша: (загруженный PDF, ключ кеша, результат из кеша или None).
+    cache_key(sha256, имя модели) строит ключ раздела; при use_cache=False кеш не читается.
+    Если что-то пошло не так после приёма, временный PDF удаляется.
+    """
+    try:
+        upload = await pdf_reader.ingest_request(request)
+    except pdf_reader.PdfTooLargeError as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    except pdf_reader.UploadFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    try:
+        key = cache_key(upload.sha256, model_name)
+        cached = await asyncio.to_thread(result_cache.get, key) if use_cache else None
+        return upload, key, cached
+    except BaseException:
+        pdf_reader.remove_temp_pdf(upload.path)
+        raise
+
+async def _prepare_llm(request: Request, model_id: int, models: List[dict], cache_key: Callable[[str, str], str],
+                       use_cache: bool = True) -> Tuple[str, pdf_reader.IngestedPdf, str, Optional[dict]]:
+    """
+    Общая часть LLM-эндпоинтов: поиск LLM-модели, приём PDF и проверка кеша.
+    Возвращает (имя модели, загруженный PDF, ключ кеша, результат из кеша или None).
+    """
+    model_name = _find_model(models, model_id)
+    return (model_name, *await _prepare_upload(request, model_name, cache_key, use_cache))
+
+async def _prepare_visual(request: Request, model_id: int,
+                          models: List[dict]) -> Tuple[str, pdf_reader.IngestedPdf, str, Optional[dict]]:
+    """
+    Общая часть визуальных эндпоинтов: поиск VLM-модели, приём PDF и проверка кеша.
+    Возвращает (имя модели, загруженный PDF, ключ кеша, результат из кеша или None).
+    """
+    model_name = _find_model(models, model_id)
+    return (model_name, *await _prepare_upload(request, model_name, _visual_cache_key))
+
+async def _visual_response(result: dict, total_slides: int, cache_key: str) -> dict:
+    result['strengths'] = result.pop('visual_strengths')
+    result['weaknesses'] = result.pop('visual_weaknesses')
+    response = {
+        "total_slides": total_slides,
+        "report": result
+    }
+    if _is_cacheable(result):
+        await asyncio.to_thread(result_cache.set, cache_key, response)
+    return response
+
+def _iter_upload_records(file: UploadFile) -> Iterator[Tuple[str, Optional[int]]]:
+    """
+    Построчно читает загруженный файл документов, не держа его в памяти целиком.
+    .jsonl/.ndjson — JSON в каждой строке: {"text": ..., "id": ...} или просто строка;
+    любой другой файл — один документ на строку.
+    """
+    is_json = file.filename.lower().endswith((".jsonl", ".ndjson"))
+    for line_number, line in enumerate(codecs.getreader("utf-8")(file.file), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if not is_json:
+            yield line, None
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Строка {line_number}: некорректный JSON")
+        if isinstance(record, str):
+            yield record, None
+        elif isinstance(record, dict) and isinstance(record.get("text"), str):
+            yield record["text"], record.get("id")
+        else:
+            raise HTTPException(status_code=400,
+                                detail=f"Строка {line_number}: ожидается строка или объект с полем text")
+
+async def _timed_section(name: str, section, timings: dict):
+    """Выполняет раздел сводного анализа, замеряя время; сбой раздела не роняет остальные."""
+    start = time.perf_counter()
+    try:
+        return await section
+    except Exception as e:
+        return {"error": f"{name} analysis failed: {e}"}
+    finally:
+        timings[name] = round(time.perf_counter() - start, 3)
+
 @router.get('/models_llm',
             summary='Все LLM-модели',
             description='Получение списка всех LLM-моделей')
@@ -64,11 +276,42 @@ async def get_llm_model(model_id : int, models = Depends(get_all_llm_models)):
         if model.get('id') == model_id : return model
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Указанной llm-модели не существует")
 
+@router.get('/ready',
+            summary='Готовность сервиса',
+            description='Какие компоненты уже загружены. 503, пока не завершён фоновый прогрев')
+async def get_readiness() -> JSONResponse:
+    components = {
+        "inference_gateway": inference_gateway.ready,
+        "embedder": embedding.is_loaded(),
+        "rag": rag_analyzer.initialized,
+        "local_models": local_backend.pool.loaded(),
+    }
+    ready = inference_gateway.ready and _warmup["state"] != "running"
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"ready": ready, "warmup": _warmup["state"], "components": components, "errors": _warmup["errors"]}
+    )
+
+@router.get('/cache_stats',
+            summary='Статистика кешей',
+            description='Попадания/промахи и занятый объём кешей результатов, артефактов PDF, подписей слайдов, '
+                        'конспектов частей презентации, ответов LLM и запросов к RAG')
+async def get_cache_stats() -> dict:
+    return {
+        "results": result_cache.stats(),
+        "artifacts": artifact_cache.stats(),
+        "captions": caption_cache.stats(),
+        "summaries": summary_cache.stats(),
+        "llm_responses": llm_cache.stats(),
+        "rag_queries": rag_analyzer.cache_stats()
+    }
+
 @router.post('/analyze/structure',
              summary='Структурный анализ',
-             description='Анализируется количество текста, удобочитаемость, последовательность изложения и т.п.')
+             description='Анализируется количество текста, удобочитаемость, последовательность изложения и т.п.',
+             openapi_extra=PDF_UPLOAD_BODY)
 async def analyze_presentation(
-    file : UploadFile = File(..., description='Загрузите презентацию в формате PDF'),
+    request: Request,
     model_id: int = Query(1, description='ID LLM-модели'),
     use_rag: bool = Query(False, description='Использование RAG-системы'),
     user_context: str = Query(None, max_length=255, description='Контекст для RAG (промт)'),
@@ -78,61 +321,110 @@ async def analyze_presentation(
     temperature: float = Query(0.0, ge=0.0, lt=1.0, description='Параметр степени случайности/креативности ответа'),
     models = Depends(get_all_llm_models)
 ) -> dict:
-    if not file.filename.lower().endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="Only PDF files are supported")
-
-    model_name = None
-    for model in models:
-        if model.get('id') == model_id : model_name = model.get('model_name')
-    if not model_name:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Модель не найдена')
-
+    # с RAG ответ зависит ещё и от содержимого коллекции, такой результат не кешируем
+    use_cache = not (use_rag and user_context)
+    model_name, upload, cache_key, cached = await _prepare_llm(
+        request, model_id, models,
+        lambda sha256, name: _structure_cache_key(sha256, name, first_slide, last_slide, max_tokens, temperature),
+        use_cache)
     try:
-        pdf_path = pdf_reader.save_temp_pdf(file)
-        slides_text = pdf_reader.extract_text_by_slides(pdf_path)
-
-        included_slides, excluded_slide_numbers = _filter_slides_by_flags(slides_text, first_slide, last_slide)
+        if cached is not None:
+            return {"filename": upload.filename, **cached}
 
-        full_text_blocks = []
-        for slide in included_slides:
-            idx = slide.get("slide_number", "?")
-            text = slide.get("text", "").strip()
-            full_text_blocks.append(f"--- SLIDE {idx} ---\n{text}")
+        slides_text = await asyncio.to_thread(pdf_reader.extract_text_by_slides, upload.path, upload.sha256)
 
-        full_text = "\n\n".join(full_text_blocks)
-        rag_output = "rag-система не использовалась"
+        included_slides, excluded_slide_numbers = _filter_slides_by_flags(slides_text, first_slide, last_slide)
 
-        if use_rag and user_context:
-            relevant_docs = rag_analyzer.query(user_context, top_k=3)
-            context_text = "\n".join([d["text"] for d in relevant_docs])
-            prompt_with_context = f"{context_text}\n\n{full_text}"
-            rag_output = rag_analyzer.query(prompt_with_context)
-        else:
-            prompt_with_context = full_text
+        full_text = _build_full_text(included_slides)
+        prompt_with_context, rag_output = await _apply_rag(full_text, use_rag, user_context)
 
         all_text_analyzer = AllTextAnalyzer(model_name=model_name, max_tokens=max_tokens, temperature=temperature)
         await all_text_analyzer.initialize_models()
-        result = all_text_analyzer.analyze_full_text(prompt_with_context)
+        result = await all_text_analyzer.analyze_full_text(prompt_with_context)
 
-        os.unlink(pdf_path)
-
-        return {
-            "filename": file.filename,
+        response = {
             "total_slides": len(slides_text),
             "excluded_slides": excluded_slide_numbers,
             "report": result,
             "rag_info": rag_output
         }
+        if use_cache and _is_cacheable(result):
+            await asyncio.to_thread(result_cache.set, cache_key, response)
+
+        return {"filename": upload.filename, **response}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+    finally:
+        pdf_reader.remove_temp_pdf(upload.path)
+
+
+@router.post('/analyze/structure/stream',
+             summary='Структурный анализ (поток)',
+             description='То же, что /analyze/structure, но результат отдаётся потоком Server-Sent Events: '
+                         'событие block по мере готовности каждого блока слайдов, затем report с итоговым отчётом',
+             openapi_extra=PDF_UPLOAD_BODY)
+async def analyze_presentation_stream(
+    request: Request,
+    model_id: int = Query(1, description='ID LLM-модели'),
+    use_rag: bool = Query(False, description='Использование RAG-системы'),
+    user_context: str = Query(None, max_length=255, description='Контекст для RAG (промт)'),
+    first_slide: bool = Query(True, description='Включение первого слайда в анализ'),
+    last_slide: bool = Query(True, description='Включение последнего слайда в анализ'),
+    max_tokens: int = Query(2000, gt=300, le=2000, description='Максимальное количество токенов для одного ответа'),
+    temperature: float = Query(0.0, ge=0.0, lt=1.0, description='Параметр степени случайности/креативности ответа'),
+    models = Depends(get_all_llm_models)
+) -> StreamingResponse:
+    use_cache = not (use_rag and user_context)
+    model_name, upload, cache_key, cached = await _prepare_llm(
+        request, model_id, models,
+        lambda sha256, name: _structure_cache_key(sha256, name, first_slide, last_slide, max_tokens, temperature),
+        use_cache)
+    filename = upload.filename
+    try:
+        if cached is not None:
+            return _event_stream(_single_report_stream({"filename": filename, **cached}))
+
+        slides_text = await asyncio.to_thread(pdf_reader.extract_text_by_slides, upload.path, upload.sha256)
+        included_slides, excluded_slide_numbers = _filter_slides_by_flags(slides_text, first_slide, last_slide)
+        prompt_with_context, rag_output = await _apply_rag(_build_full_text(included_slides), use_rag, user_context)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+    finally:
+        # дальше нужен только текст слайдов, PDF можно удалить до начала стрима
+        pdf_reader.remove_temp_pdf(upload.path)
+
+    all_text_analyzer = AllTextAnalyzer(model_name=model_name, max_tokens=max_tokens, temperature=temperature)
+    await all_text_analyzer.initialize_models()
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            async for event in all_text_analyzer.iter_full_text_analysis(prompt_with_context):
+                if event["event"] != "report":
+                    yield _sse(event["event"], event["data"])
+                    continue
+                response = {
+                    "total_slides": len(slides_text),
+                    "excluded_slides": excluded_slide_numbers,
+                    "report": event["data"],
+                    "rag_info": rag_output
+                }
+                if use_cache and _is_cacheable(event["data"]):
+                    await asyncio.to_thread(result_cache.set, cache_key, response)
+                yield _sse("report", {"filename": filename, **response})
+        except Exception as e:
+            yield _sse("error", {"detail": f"Analysis failed: {e}"})
+
+    return _event_stream(events())
 
 
 @router.post("/analyze/content",
              summary='Анализ контента',
-             description='Анализируется смысловая нагрузка, делается выкладка со всей презентации')
+             description='Анализируется смысловая нагрузка, делается выкладка со всей презентации',
+             openapi_extra=PDF_UPLOAD_BODY)
 async def analyze_content(
-    file : UploadFile = File(..., description='Загрузите презентацию в формате PDF'),
+    request: Request,
     model_id: int = Query(1, description='ID LLM-модели'),
     first_slide: bool = Query(True, description='Включение первого слайда в анализ'),
     last_slide: bool = Query(True, description='Включение последнего слайда в анализ'),
@@ -140,84 +432,219 @@ async def analyze_content(
     temperature: float = Query(0.0, ge=0.0, lt=1.0, description='Параметр степени случайности/креативности ответа'),
     models = Depends(get_all_llm_models)
 ) -> dict:
-    if not file.filename.lower().endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="Only PDF files are supported")
-
-    model_name = None
-    for model in models:
-        if model.get('id') == model_id : model_name = model.get('model_name')
-    if not model_name:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Модель не найдена')
-
+    model_name, upload, cache_key, cached = await _prepare_llm(
+        request, model_id, models,
+        lambda sha256, name: _content_cache_key(sha256, name, first_slide, last_slide, max_tokens, temperature))
     try:
-        pdf_path = pdf_reader.save_temp_pdf(file)
-        slides_text = pdf_reader.extract_text_by_slides(pdf_path)
+        if cached is not None:
+            return {"filename": upload.filename, **cached}
 
-        included_slides, excluded_slide_numbers = _filter_slides_by_flags(slides_text, first_slide, last_slide)
+        slides_text = await asyncio.to_thread(pdf_reader.extract_text_by_slides, upload.path, upload.sha256)
 
-        full_text_blocks = []
-        for slide in included_slides:
-            idx = slide.get("slide_number", "?")
-            text = slide.get("text", "").strip()
-            full_text_blocks.append(f"--- SLIDE {idx} ---\n{text}")
+        included_slides, excluded_slide_numbers = _filter_slides_by_flags(slides_text, first_slide, last_slide)
 
-        full_text = "\n\n".join(full_text_blocks)
+        full_text = _build_full_text(included_slides)
 
         content_analyzer = ContentAnalyzer(model_name=model_name, max_tokens=max_tokens, temperature=temperature)
         await content_analyzer.initialize_models()
-        analysis = content_analyzer.analyze_full_content(full_text)
-
-        os.unlink(pdf_path)
+        analysis = await content_analyzer.analyze_full_content(full_text)
 
-        return {
-            "filename": file.filename,
+        response = {
             "total_slides": len(slides_text),
             "excluded_slides": excluded_slide_numbers,
             "report": analysis
         }
+        if _is_cacheable(analysis):
+            await asyncio.to_thread(result_cache.set, cache_key, response)
+
+        return {"filename": upload.filename, **response}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Content analysis failed: {e}")
+    finally:
+        pdf_reader.remove_temp_pdf(upload.path)
 
 @router.post("/analyze/visual",
              summary='Визуальный анализ',
-             description='Анализируется заболоченность текста/изображений на слайде')
+             description='Анализируется заболоченность текста/изображений на слайде',
+             openapi_extra=PDF_UPLOAD_BODY)
 async def analyze_visual(
-        file: UploadFile = File(...),
+        request: Request,
         model_id: int = Query(1, description='ID VLM-модели'),
         models = Depends(get_all_vlm_models)
 ) -> dict:
-    if not file.filename.lower().endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="Only PDF files are supported")
-
+    model_name, upload, cache_key, cached = await _prepare_visual(request, model_id, models)
     try:
-        pdf_path = pdf_reader.save_temp_pdf(file)
-
-        slide_images = pdf_reader.pdf_to_images(pdf_path)
-
-        model_name = None
-        for model in models:
-            if model.get('id') == model_id: model_name = model.get('model_name')
-        if not model_name:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Модель не найдена')
+        if cached is not None:
+            return {"filename": upload.filename, **cached}
 
         image_analyzer = ImageAnalyzer(model_name=model_name)
         await image_analyzer.initialize_models()
-        result = await image_analyzer.analyze_visual_presentation(slide_images)
 
-        result['strengths'] = result.pop('visual_strengths')
-        result['weaknesses'] = result.pop('visual_weaknesses')
+        # слайды рендерятся по мере анализа, окнами по RENDER_WINDOW_SIZE
+        with pdf_reader.PdfDocument(upload.path, sha256=upload.sha256) as document:
+            total_slides = await asyncio.to_thread(lambda: document.page_count)
+            result = await image_analyzer.analyze_visual_presentation(document.aiter_images())
+
+        return {"filename": upload.filename, **await _visual_response(result, total_slides, cache_key)}
 
-        os.unlink(pdf_path)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        pdf_reader.remove_temp_pdf(upload.path)
+
+@router.post("/analyze/visual/stream",
+             summary='Визуальный анализ (поток)',
+             description='То же, что /analyze/visual, но результат отдаётся потоком Server-Sent Events: '
+                         'событие slide с подписью и метриками каждого слайда, затем report с итоговым отчётом',
+             openapi_extra=PDF_UPLOAD_BODY)
+async def analyze_visual_stream(
+        request: Request,
+        model_id: int = Query(1, description='ID VLM-модели'),
+        models = Depends(get_all_vlm_models)
+) -> StreamingResponse:
+    model_name, upload, cache_key, cached = await _prepare_visual(request, model_id, models)
+    filename = upload.filename
+    if cached is not None:
+        pdf_reader.remove_temp_pdf(upload.path)
+        return _event_stream(_single_report_stream({"filename": filename, **cached}))
 
+    try:
+        image_analyzer = ImageAnalyzer(model_name=model_name)
+        await image_analyzer.initialize_models()
+    except BaseException:
+        pdf_reader.remove_temp_pdf(upload.path)
+        raise
+
+    async def events() -> AsyncIterator[str]:
+        # PDF нужен на всё время стрима: слайды рендерятся по мере анализа
+        try:
+            with pdf_reader.PdfDocument(upload.path, sha256=upload.sha256) as document:
+                total_slides = await asyncio.to_thread(lambda: document.page_count)
+                async for event in image_analyzer.iter_visual_presentation(document.aiter_images()):
+                    if event["event"] != "report":
+                        yield _sse(event["event"], event["data"])
+                        continue
+                    response = await _visual_response(event["data"], total_slides, cache_key)
+                    yield _sse("report", {"filename": filename, **response})
+        except Exception as e:
+            yield _sse("error", {"detail": str(e)})
+
+    # PDF удаляется фоновой задачей ответа: она выполняется и тогда, когда клиент
+    # отключился до начала итерации и генератор events так и не был запущен
+    return _event_stream(events(), background=BackgroundTask(pdf_reader.remove_temp_pdf, upload.path))
+
+@router.post("/analyze/all",
+             summary='Полный анализ',
+             description='Структурный, контентный и визуальный анализ за один запрос: PDF загружается и разбирается '
+                         'один раз, анализаторы работают одновременно. В timings — время каждого раздела в секундах',
+             openapi_extra=PDF_UPLOAD_BODY)
+async def analyze_all(
+    request: Request,
+    llm_model_id: int = Query(1, description='ID LLM-модели'),
+    vlm_model_id: int = Query(1, description='ID VLM-модели'),
+    use_rag: bool = Query(False, description='Использование RAG-системы'),
+    user_context: str = Query(None, max_length=255, description='Контекст для RAG (промт)'),
+    first_slide: bool = Query(True, description='Включение первого слайда в анализ'),
+    last_slide: bool = Query(True, description='Включение последнего слайда в анализ'),
+    max_tokens: int = Query(2000, gt=300, le=2000, description='Максимальное количество токенов для одного ответа'),
+    temperature: float = Query(0.0, ge=0.0, lt=1.0, description='Параметр степени случайности/креативности ответа'),
+    llm_models = Depends(get_all_llm_models),
+    vlm_models = Depends(get_all_vlm_models)
+) -> dict:
+    # модели проверяются до приёма PDF, чтобы не читать тело запроса впустую
+    vlm_model_name = _find_model(vlm_models, vlm_model_id)
+
+    started = time.perf_counter()
+    timings = {}
+    # ключи те же, что у отдельных эндпоинтов, поэтому разделы берутся из кеша и попадают в него
+    use_structure_cache = not (use_rag and user_context)
+    llm_model_name, upload, structure_key, structure_cached = await _prepare_llm(
+        request, llm_model_id, llm_models,
+        lambda sha256, name: _structure_cache_key(sha256, name, first_slide, last_slide, max_tokens, temperature),
+        use_structure_cache)
+    timings["ingest"] = round(time.perf_counter() - started, 3)
+    try:
+        content_key = _content_cache_key(upload.sha256, llm_model_name, first_slide, last_slide,
+                                         max_tokens, temperature)
+        visual_key = _visual_cache_key(upload.sha256, vlm_model_name)
+        content_cached = await asyncio.to_thread(result_cache.get, content_key)
+        visual_cached = await asyncio.to_thread(result_cache.get, visual_key)
+
+        with pdf_reader.PdfDocument(upload.path, sha256=upload.sha256) as document:
+            total_slides = await asyncio.to_thread(lambda: document.page_count)
+
+            # текст извлекается один раз и нужен только тем разделам, которых нет в кеше
+            parse_started = time.perf_counter()
+            slides_text = []
+            if structure_cached is None or content_cached is None:
+                slides_text = await asyncio.to_thread(document.slides_text)
+            included_slides, excluded_slide_numbers = _filter_slides_by_flags(slides_text, first_slide, last_slide)
+            full_text = _build_full_text(included_slides)
+            timings["parse"] = round(time.perf_counter() - parse_started, 3)
+
+            async def structure() -> dict:
+                if structure_cached is not None:
+                    return structure_cached
+                prompt_with_context, rag_output = await _apply_rag(full_text, use_rag, user_context)
+                all_text_analyzer = AllTextAnalyzer(model_name=llm_model_name, max_tokens=max_tokens,
+                                                    temperature=temperature)
+                await all_text_analyzer.initialize_models()
+                result = await all_text_analyzer.analyze_full_text(prompt_with_context)
+                response = {
+                    "total_slides": total_slides,
+                    "excluded_slides": excluded_slide_numbers,
+                    "report": result,
+                    "rag_info": rag_output
+                }
+                if use_structure_cache and _is_cacheable(result):
+                    await asyncio.to_thread(result_cache.set, structure_key, response)
+                return response
+
+            async def content() -> dict:
+                if content_cached is not None:
+                    return content_cached
+                content_analyzer = ContentAnalyzer(model_name=llm_model_name, max_tokens=max_tokens,
+                                                   temperature=temperature)
+                await content_analyzer.initialize_models()
+                analysis = await content_analyzer.analyze_full_content(full_text)
+                response = {
+                    "total_slides": total_slides,
+                    "excluded_slides": excluded_slide_numbers,
+                    "report": analysis
+                }
+                if _is_cacheable(analysis):
+                    await asyncio.to_thread(result_cache.set, content_key, response)
+                return response
+
+            async def visual() -> dict:
+                if visual_cached is not None:
+                    return visual_cached
+                image_analyzer = ImageAnalyzer(model_name=vlm_model_name)
+                await image_analyzer.initialize_models()
+                result = await image_analyzer.analyze_visual_presentation(document.aiter_images())
+                return await _visual_response(result, total_slides, visual_key)
+
+            structure_result, content_result, visual_result = await asyncio.gather(
+                _timed_section("structure", structure(), timings),
+                _timed_section("content", content(), timings),
+                _timed_section("visual", visual(), timings),
+            )
+
+        timings["total"] = round(time.perf_counter() - started, 3)
         return {
-            "filename": file.filename,
-            "total_slides": len(slide_images),
-            "report": result
+            "filename": upload.filename,
+            "total_slides": total_slides,
+            "structure": structure_result,
+            "content": content_result,
+            "visual": visual_result,
+            "timings": timings
         }
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+    finally:
+        pdf_reader.remove_temp_pdf(upload.path)
 
 @router.post("/add",
              summary='Дополнение RAG-системы контекстом',
@@ -227,15 +654,39 @@ def add_documents_to_rag(data: AddDocumentsRequest) -> dict:
         if not rag_analyzer.initialized:
             rag_analyzer.initialize()
 
-        rag_analyzer.add_documents(
+        added = rag_analyzer.add_documents(
             docs=data.documents,
             ids=data.ids
         )
 
         return {
             "status": "success",
-            "added": len(data.documents)
+            "added": added
         }
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/add/file",
+             summary='Дополнение RAG-системы из файла',
+             description='Потоковая загрузка документов в коллекцию RAG (Qdrant) из файла: .jsonl/.ndjson '
+                         '(в строке — {"text": ..., "id": ...} или строка) либо текстовый файл, один документ на строку')
+def add_file_to_rag(file: UploadFile = File(..., description='Файл с документами')) -> dict:
+    try:
+        if not rag_analyzer.initialized:
+            rag_analyzer.initialize()
+
+        added = rag_analyzer.add_records(_iter_upload_records(file))
+
+        return {
+            "status": "success",
+            "added": added
+        }
+
+    except HTTPException:
+        # документы до ошибочной строки уже загружены
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
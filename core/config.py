@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 
@@ -7,12 +8,107 @@ HUGGINGFACE_HUB_TOKEN = os.getenv('HUGGINGFACE_HUB_TOKEN')
 QDRANT_URL = os.getenv('QDRANT_URL')
 QDRANT_API_KEY = os.getenv('QDRANT_API_KEY')
 
-llm_models_list = [{'id' : 1, 'model_name' : 'IlyaGusev/saiga_llama3_8b', 'dev_level' : 'hard'},
-               {'id' : 2, 'model_name' : 'distilgpt2', 'dev_level' : 'light'}]
+# Приём загружаемых PDF
+MAX_UPLOAD_SIZE_MB = int(os.getenv('MAX_UPLOAD_SIZE_MB', 100))
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+PDF_OPEN_MMAP = os.getenv('PDF_OPEN_MMAP', 'false').lower() in ('1', 'true', 'yes')
 
-vlm_models_list = [{'id' : 1, 'model_name' : 'Salesforce/blip2-flan-t5-xl', 'dev_level' : 'light'},
-                   {'id' : 2, 'model_name' : 'microsoft/Florence-2-large', 'dev_level' : 'medium'},
-                   {'id' : 3, 'model_name' : 'Qwen/Qwen2-VL-7B-Instruct', 'dev_level' : 'medium'}]
+# Растеризация слайдов
+RENDER_DPI = int(os.getenv('RENDER_DPI', 200))
+RENDER_MAX_DIMENSION = int(os.getenv('RENDER_MAX_DIMENSION', 2000))
+RENDER_WINDOW_SIZE = int(os.getenv('RENDER_WINDOW_SIZE', 8))
+
+# Параллельный разбор больших PDF в пуле процессов
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', os.cpu_count() or 1))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 32))
+
+# Кеш результатов анализа и промежуточных артефактов
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CACHE_DIR = os.getenv('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'praireader_cache'))
+CACHE_TTL_SECONDS = int(os.getenv('CACHE_TTL_SECONDS', 7 * 24 * 3600))
+CACHE_MAX_DISK_MB = int(os.getenv('CACHE_MAX_DISK_MB', 2048))
+CACHE_MEMORY_MB = int(os.getenv('CACHE_MEMORY_MB', 256))
+CAPTION_CACHE_MAX_DISK_MB = int(os.getenv('CAPTION_CACHE_MAX_DISK_MB', 256))
+CACHE_PAGE_IMAGES = os.getenv('CACHE_PAGE_IMAGES', 'false').lower() in ('1', 'true', 'yes')
+
+# Общий клиент HF Inference
+INFERENCE_MAX_CONCURRENCY = int(os.getenv('INFERENCE_MAX_CONCURRENCY', 32))
+INFERENCE_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT', 120))
+LLM_STREAM_EARLY_STOP = os.getenv('LLM_STREAM_EARLY_STOP', 'true').lower() in ('1', 'true', 'yes')
+
+# Кеш ответов LLM
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+LLM_CACHE_MAX_ITEMS = int(os.getenv('LLM_CACHE_MAX_ITEMS', 2048))
+LLM_CACHE_SQLITE_PATH = os.getenv('LLM_CACHE_SQLITE_PATH', '')
+LLM_CACHE_SQLITE_MAX_ROWS = int(os.getenv('LLM_CACHE_SQLITE_MAX_ROWS', 100000))
+LLM_CACHE_NONZERO_TEMPERATURE = os.getenv('LLM_CACHE_NONZERO_TEMPERATURE', 'false').lower() in ('1', 'true', 'yes')
+
+# Структурный анализ: блоки слайдов отправляются в LLM параллельно
+LLM_BLOCK_CONCURRENCY = int(os.getenv('LLM_BLOCK_CONCURRENCY', 4))
+LLM_BLOCK_TIMEOUT = float(os.getenv('LLM_BLOCK_TIMEOUT', 120))
+LLM_PROMPT_TOKEN_BUDGET = int(os.getenv('LLM_PROMPT_TOKEN_BUDGET', 0))
+LLM_USE_TOKENIZER = os.getenv('LLM_USE_TOKENIZER', 'true').lower() in ('1', 'true', 'yes')
+
+# Анализ контента длинных презентаций: конспекты частей (map) -> итоговый анализ (reduce)
+CONTENT_MAP_REDUCE = os.getenv('CONTENT_MAP_REDUCE', 'auto').lower()
+CONTENT_CHUNK_SUMMARY_TOKENS = int(os.getenv('CONTENT_CHUNK_SUMMARY_TOKENS', 400))
+
+# Локальный backend (transformers на CPU)
+LOCAL_LLM_ENABLED = os.getenv('LOCAL_LLM_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+LOCAL_MODEL_POOL_MB = int(os.getenv('LOCAL_MODEL_POOL_MB', 2048))
+LOCAL_BATCH_SIZE = int(os.getenv('LOCAL_BATCH_SIZE', 8))
+LOCAL_BATCH_WAIT_MS = int(os.getenv('LOCAL_BATCH_WAIT_MS', 20))
+LOCAL_TORCH_THREADS = int(os.getenv('LOCAL_TORCH_THREADS', 0))
+
+# Подписи слайдов VLM-моделью
+VLM_CONCURRENCY = int(os.getenv('VLM_CONCURRENCY', 8))
+VLM_CAPTION_TIMEOUT = float(os.getenv('VLM_CAPTION_TIMEOUT', 60))
+DEDUP_HAMMING_THRESHOLD = int(os.getenv('DEDUP_HAMMING_THRESHOLD', 6))
+VLM_IMAGE_MAX_BYTES = int(os.getenv('VLM_IMAGE_MAX_BYTES', 400 * 1024))
+
+# Прогрев при старте: модель эмбеддингов и подключение к Qdrant загружаются в фоне
+WARMUP_ON_STARTUP = os.getenv('WARMUP_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+
+# Движок эмбеддингов: 'torch' (sentence-transformers) или 'onnx' (onnxruntime, int8-квантизация)
+EMBEDDING_ENGINE = os.getenv('EMBEDDING_ENGINE', 'torch').lower()
+EMBEDDING_ONNX_DIR = os.getenv('EMBEDDING_ONNX_DIR', os.path.join(CACHE_DIR, 'onnx'))
+EMBEDDING_ONNX_THREADS = int(os.getenv('EMBEDDING_ONNX_THREADS', 0))
+EMBEDDING_ONNX_MAX_BATCH_TOKENS = int(os.getenv('EMBEDDING_ONNX_MAX_BATCH_TOKENS', 8192))
+EMBEDDING_ONNX_MIN_COSINE = float(os.getenv('EMBEDDING_ONNX_MIN_COSINE', 0.98))
+
+# Хранилище RAG: 'qdrant' (QDRANT_URL/QDRANT_API_KEY) или 'local' (индекс NumPy в RAG_LOCAL_DIR)
+RAG_BACKEND = os.getenv('RAG_BACKEND', 'qdrant').lower()
+RAG_LOCAL_DIR = os.getenv('RAG_LOCAL_DIR', 'rag_index')
+RAG_LOCAL_IVF_LISTS = int(os.getenv('RAG_LOCAL_IVF_LISTS', 0))
+RAG_LOCAL_IVF_NPROBE = int(os.getenv('RAG_LOCAL_IVF_NPROBE', 8))
+
+# Загрузка документов в RAG: эмбеддинги батчами, upsert частями
+RAG_EMBED_BATCH_SIZE = int(os.getenv('RAG_EMBED_BATCH_SIZE', 64))
+RAG_UPSERT_BATCH_SIZE = int(os.getenv('RAG_UPSERT_BATCH_SIZE', 512))
+RAG_UPSERT_PARALLEL = int(os.getenv('RAG_UPSERT_PARALLEL', 2))
+
+# Кеш запросов к RAG: эмбеддинги запросов и результаты поиска
+RAG_QUERY_CACHE_SIZE = int(os.getenv('RAG_QUERY_CACHE_SIZE', 512))
+RAG_QUERY_CACHE_TTL = int(os.getenv('RAG_QUERY_CACHE_TTL', 600))
+
+# context_window — размер контекста модели в токенах, по нему считается бюджет промпта
+# backend — 'remote' (HF Inference) или 'local' (transformers на CPU внутри процесса)
+llm_models_list = [{'id' : 1, 'model_name' : 'IlyaGusev/saiga_llama3_8b', 'dev_level' : 'hard', 'context_window' : 8192,
+                    'backend' : 'remote'},
+               {'id' : 2, 'model_name' : 'distilgpt2', 'dev_level' : 'light', 'context_window' : 1024,
+                    'backend' : 'remote'}]
+# та же модель, но генерация на CPU внутри процесса — только при LOCAL_LLM_ENABLED
+if LOCAL_LLM_ENABLED:
+    llm_models_list.append({'id' : 3, 'model_name' : 'distilbert/distilgpt2', 'dev_level' : 'light',
+                            'context_window' : 1024, 'backend' : 'local'})
+
+# max_image_side / image_format / image_quality — как готовить изображение слайда перед отправкой в модель
+vlm_models_list = [{'id' : 1, 'model_name' : 'Salesforce/blip2-flan-t5-xl', 'dev_level' : 'light',
+                    'max_image_side' : 640, 'image_format' : 'JPEG', 'image_quality' : 85},
+                   {'id' : 2, 'model_name' : 'microsoft/Florence-2-large', 'dev_level' : 'medium',
+                    'max_image_side' : 1024, 'image_format' : 'JPEG', 'image_quality' : 85},
+                   {'id' : 3, 'model_name' : 'Qwen/Qwen2-VL-7B-Instruct', 'dev_level' : 'medium',
+                    'max_image_side' : 1280, 'image_format' : 'WEBP', 'image_quality' : 80}]
 
 
 def get_hf_token():
@@ -24,8 +120,170 @@ def get_qdrant_url():
 def get_qdrant_api_key():
     return QDRANT_API_KEY
 
+def get_max_upload_size():
+    return MAX_UPLOAD_SIZE_MB * 1024 * 1024
+
+def get_upload_chunk_size():
+    return UPLOAD_CHUNK_SIZE
+
+def get_pdf_open_mmap():
+    return PDF_OPEN_MMAP
+
+def get_render_dpi():
+    return RENDER_DPI
+
+def get_render_max_dimension():
+    return RENDER_MAX_DIMENSION
+
+def get_render_window_size():
+    return RENDER_WINDOW_SIZE
+
+def get_pdf_workers():
+    return PDF_WORKERS
+
+def get_pdf_parallel_min_pages():
+    return PDF_PARALLEL_MIN_PAGES
+
+def get_cache_enabled():
+    return CACHE_ENABLED
+
+def get_cache_dir():
+    return CACHE_DIR
+
+def get_cache_ttl():
+    return CACHE_TTL_SECONDS
+
+def get_cache_max_disk_bytes():
+    return CACHE_MAX_DISK_MB * 1024 * 1024
+
+def get_cache_memory_bytes():
+    return CACHE_MEMORY_MB * 1024 * 1024
+
+def get_cache_page_images():
+    return CACHE_PAGE_IMAGES
+
+def get_caption_cache_max_disk_bytes():
+    return CAPTION_CACHE_MAX_DISK_MB * 1024 * 1024
+
+def get_inference_max_concurrency():
+    return INFERENCE_MAX_CONCURRENCY
+
+def get_inference_timeout():
+    return INFERENCE_TIMEOUT
+
+def get_llm_stream_early_stop():
+    return LLM_STREAM_EARLY_STOP
+
+def get_llm_cache_enabled():
+    return LLM_CACHE_ENABLED
+
+def get_llm_cache_max_items():
+    return LLM_CACHE_MAX_ITEMS
+
+def get_llm_cache_sqlite_path():
+    return LLM_CACHE_SQLITE_PATH
+
+def get_llm_cache_sqlite_max_rows():
+    return LLM_CACHE_SQLITE_MAX_ROWS
+
+def get_llm_cache_nonzero_temperature():
+    return LLM_CACHE_NONZERO_TEMPERATURE
+
+def get_llm_block_concurrency():
+    return LLM_BLOCK_CONCURRENCY
+
+def get_llm_block_timeout():
+    return LLM_BLOCK_TIMEOUT
+
+def get_llm_prompt_token_budget():
+    return LLM_PROMPT_TOKEN_BUDGET
+
+def get_llm_use_tokenizer():
+    return LLM_USE_TOKENIZER
+
+def get_content_map_reduce():
+    return CONTENT_MAP_REDUCE
+
+def get_content_chunk_summary_tokens():
+    return CONTENT_CHUNK_SUMMARY_TOKENS
+
+def get_local_model_pool_bytes():
+    return LOCAL_MODEL_POOL_MB * 1024 * 1024
+
+def get_local_batch_size():
+    return LOCAL_BATCH_SIZE
+
+def get_local_batch_wait():
+    return LOCAL_BATCH_WAIT_MS / 1000
+
+def get_local_torch_threads():
+    return LOCAL_TORCH_THREADS
+
+def get_vlm_concurrency():
+    return VLM_CONCURRENCY
+
+def get_vlm_caption_timeout():
+    return VLM_CAPTION_TIMEOUT
+
+def get_dedup_hamming_threshold():
+    return DEDUP_HAMMING_THRESHOLD
+
+def get_vlm_image_max_bytes():
+    return VLM_IMAGE_MAX_BYTES
+
+def get_warmup_on_startup():
+    return WARMUP_ON_STARTUP
+
+def get_embedding_engine():
+    return EMBEDDING_ENGINE
+
+def get_embedding_onnx_dir():
+    return EMBEDDING_ONNX_DIR
+
+def get_embedding_onnx_threads():
+    return EMBEDDING_ONNX_THREADS
+
+def get_embedding_onnx_max_batch_tokens():
+    return EMBEDDING_ONNX_MAX_BATCH_TOKENS
+
+def get_embedding_onnx_min_cosine():
+    return EMBEDDING_ONNX_MIN_COSINE
+
+def get_rag_backend():
+    return RAG_BACKEND
+
+def get_rag_local_dir():
+    return RAG_LOCAL_DIR
+
+def get_rag_local_ivf_lists():
+    return RAG_LOCAL_IVF_LISTS
+
+def get_rag_local_ivf_nprobe():
+    return RAG_LOCAL_IVF_NPROBE
+
+def get_rag_embed_batch_size():
+    return RAG_EMBED_BATCH_SIZE
+
+def get_rag_upsert_batch_size():
+    return RAG_UPSERT_BATCH_SIZE
+
+def get_rag_upsert_parallel():
+    return RAG_UPSERT_PARALLEL
+
+def get_rag_query_cache_size():
+    return RAG_QUERY_CACHE_SIZE
+
+def get_rag_query_cache_ttl():
+    return RAG_QUERY_CACHE_TTL
+
 def get_llm_models_list():
     return llm_models_list
 
 def get_vlm_models_list():
-    return vlm_models_list
\ No newline at end of file
+    return vlm_models_list
+
+def get_llm_model_entry(model_name):
+    for model in llm_models_list:
+        if model.get('model_name') == model_name:
+            return model
+    return None
\ No newline at end of file
@@ -1,66 +1,91 @@
 # utils/all_text_analyzer.py
 
+import asyncio
 import json
 import re
-from typing import Dict, Any, List, Optional
-from huggingface_hub import InferenceClient
-from core.config import get_hf_token
+from typing import Dict, Any, List, Optional, AsyncIterator
+from core.config import get_llm_block_concurrency, get_llm_block_timeout
+from utils.inference_gateway import InferenceGateway, inference_gateway
+from utils.slide_index import SlideIndex
+from utils.token_budget import count_tokens, pack_by_budget, prompt_budget, clamp_max_tokens
 
 
 class AllTextAnalyzer:
     """
     Анализирует структуру презентации: плотность текста, читаемость, заголовки.
-    Поддерживает большие презентации за счет разбивки на блоки слайдов.
+    Поддерживает большие презентации за счет разбивки на блоки слайдов по бюджету токенов модели.
     """
 
     def __init__(self, model_name, max_tokens, temperature):
-        self.hf_token: Optional[str] = get_hf_token()
-        self.client: Optional[InferenceClient] = None
+        self.client: Optional[InferenceGateway] = None
         self.model_name: str = model_name
         self.models_initialized: bool = False
-        self.slides_per_block: int = 5
-        self.max_tokens = max_tokens
+        self.max_tokens = clamp_max_tokens(model_name, max_tokens, "AllTextAnalyzer")
         self.temperature = temperature
 
     async def initialize_models(self) -> None:
         if self.models_initialized:
             return
         try:
-            self.client = InferenceClient(token=self.hf_token)
+            await inference_gateway.start()
+            self.client = inference_gateway
             self.models_initialized = True
-            print(f"[AllTextAnalyzer] InferenceClient ready (model {self.model_name})")
+            print(f"[AllTextAnalyzer] InferenceGateway ready (model {self.model_name})")
         except Exception as e:
             print(f"[AllTextAnalyzer] init error: {e}")
             self.models_initialized = False
 
-    def analyze_full_text(self, full_text: str) -> Dict[str, Any]:
+    async def analyze_full_text(self, full_text: str) -> Dict[str, Any]:
         """
         Анализ всей презентации.
         Разбиваем текст на блоки, генерируем JSON для каждого блока, потом объединяем.
         После объединения пытаемся автоматом сопоставить найденные weaknesses/recommendations
         с номерами слайдов (если модель не указала их напрямую).
         """
+        combined: Dict[str, Any] = {}
+        async for event in self.iter_full_text_analysis(full_text):
+            if event["event"] == "report":
+                combined = event["data"]
+        return combined
+
+    async def iter_full_text_analysis(self, full_text: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        То же, что analyze_full_text, но по шагам: событие "block" отдаётся,
+        как только готов очередной блок (в порядке готовности), затем
+        событие "report" с объединённым результатом.
+        """
         clean_text = self._normalize_full_text(full_text)
         if not self.models_initialized or not self.client:
-            return self._fallback_summary(clean_text)
+            yield {"event": "report", "data": self._fallback_summary(clean_text)}
+            return
 
         slide_texts = re.split(r'(--- SLIDE \d+ ---)', clean_text)
-        blocks = self._make_blocks(slide_texts, self.slides_per_block)
+        # подсчёт токенов может загрузить токенизатор модели — не блокируем event loop
+        blocks = await asyncio.to_thread(self._make_blocks, slide_texts)
 
-        # Генерируем JSON для каждого блока
-        block_results = []
-        for block_text in blocks:
-            prompt = self._build_prompt_for_structural_analysis(block_text)
-            raw = self._call_chat_model(prompt, max_tokens=self.max_tokens, temperature=self.temperature)
-            parsed = self._try_parse_json(raw)
-            if parsed:
-                block_results.append(parsed)
-            else:
-                # fallback на блок
-                block_results.append(self._fallback_summary(clean_text))
+        # Генерируем JSON для всех блоков параллельно (не больше LLM_BLOCK_CONCURRENCY одновременно)
+        semaphore = asyncio.Semaphore(get_llm_block_concurrency())
+        tasks = [asyncio.create_task(self._analyze_block(block_text, clean_text, semaphore))
+                 for block_text in blocks]
+        block_numbers = {task: i for i, task in enumerate(tasks)}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=block_numbers.get):
+                    i = block_numbers[task]
+                    yield {"event": "block", "data": {
+                        "block": i + 1,
+                        "total_blocks": len(blocks),
+                        "slides": [int(n) for n in re.findall(r'--- SLIDE (\d+) ---', blocks[i])],
+                        "result": task.result(),
+                    }}
+        finally:
+            for task in pending:
+                task.cancel()
 
-        # Объединяем результаты всех блоков
-        combined = self._merge_block_results(block_results)
+        # Объединяем результаты всех блоков в исходном порядке
+        combined = self._merge_block_results([task.result() for task in tasks])
 
         # Попытка сопоставить элементы с номерами слайдов по содержимому,
         # только если модель сама не дала явные номера.
@@ -70,31 +95,49 @@ class AllTextAnalyzer:
             # не ломаем основной поток анализа, просто логируем
             print(f"[AllTextAnalyzer] slide mapping warning: {e}")
 
-        return combined
+        yield {"event": "report", "data": combined}
+
+    async def _analyze_block(self, block_text: str, clean_text: str, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+        prompt = self._build_prompt_for_structural_analysis(block_text)
+        async with semaphore:
+            try:
+                raw = await asyncio.wait_for(
+                    self._call_chat_model(prompt, max_tokens=self.max_tokens, temperature=self.temperature),
+                    timeout=get_llm_block_timeout()
+                )
+            except asyncio.TimeoutError:
+                print("[AllTextAnalyzer] block timeout")
+                raw = ""
+        parsed = self._try_parse_json(raw)
+        if parsed:
+            return parsed
+        # fallback на блок
+        return self._fallback_summary(clean_text)
 
     # ---- блокировка слайдов -------------------------------------------------
-    def _make_blocks(self, slides: List[str], block_size: int) -> List[str]:
+    def _make_blocks(self, slides: List[str]) -> List[str]:
         """
-        slides: ['--- SLIDE 1 ---', 'text1', '--- SLIDE 2 ---', 'text2', ...]
-        Возвращает список текстов блоков по block_size слайдов.
+        slides: ['prefix', '--- SLIDE 1 ---', 'text1', '--- SLIDE 2 ---', 'text2', ...]
+        (результат re.split с захватом маркеров; prefix — текст до первого маркера, например контекст RAG).
+        Слайды упаковываются в блоки по бюджету токенов модели: блок заполняется целыми слайдами,
+        пока помещается в контекст за вычетом инструкции и max_tokens на ответ.
         """
-        blocks = []
-        current_block = []
-        count = 0
-        for i in range(0, len(slides), 2):
-            if i + 1 >= len(slides):
-                break
+        prefix = slides[0].strip() if slides else ""
+        units = []
+        for i in range(1, len(slides), 2):
             header = slides[i]
-            text = slides[i + 1]
-            current_block.append(f"{header}\n{text}")
-            count += 1
-            if count >= block_size:
-                blocks.append("\n\n".join(current_block))
-                current_block = []
-                count = 0
-        if current_block:
-            blocks.append("\n\n".join(current_block))
-        return blocks
+            text = slides[i + 1].strip() if i + 1 < len(slides) else ""
+            units.append(f"{header}\n{text}")
+        if prefix:
+            if units:
+                units[0] = f"{prefix}\n\n{units[0]}"
+            else:
+                units.append(prefix)
+
+        reserved = count_tokens(self._build_prompt_for_structural_analysis(""), self.model_name) + 32
+        budget = prompt_budget(self.model_name, self.max_tokens, reserved)
+        groups = pack_by_budget(units, budget, self.model_name)
+        return ["\n\n".join(units[i] for i in group) for group in groups]
 
     def _build_prompt_for_structural_analysis(self, text: str) -> str:
         instruction = (
@@ -110,29 +153,18 @@ class AllTextAnalyzer:
         )
         return instruction + "\n\n" + text
 
-    def _call_chat_model(self, user_prompt: str, max_tokens: int = 2000, temperature: float = 0.0) -> str:
+    async def _call_chat_model(self, user_prompt: str, max_tokens: int = 2000, temperature: float = 0.0) -> str:
         if not self.client:
             return ""
         try:
-            response = self.client.chat_completion(
+            text_out = await self.client.chat(
                 model=self.model_name,
                 messages=[{"role": "user", "content": user_prompt}],
                 max_tokens=max_tokens,
                 temperature=temperature,
                 top_p=0.9,
+                stop_on_json=True,
             )
-            text_out = ""
-            if isinstance(response, dict):
-                choices = response.get("choices") or response.get("outputs")
-                if choices and isinstance(choices, list) and len(choices) > 0:
-                    first = choices[0]
-                    msg = first.get("message") or first
-                    if isinstance(msg, dict):
-                        text_out = msg.get("content") or msg.get("text") or ""
-                    else:
-                        text_out = str(first)
-            else:
-                text_out = str(response)
             return self._clean_response(text_out)
         except Exception as e:
             print(f"[AllTextAnalyzer] LLM call error: {e}")
@@ -140,14 +172,27 @@ class AllTextAnalyzer:
 
     # ---- объединение результатов блоков ---------------------------------
     def _merge_block_results(self, results: List[Dict[str, Any]]) -> Dict[str, Any]:
-        combined = results[0] if results else {}
+        # блоки, на которых модель не ответила (таймаут, ошибка, невалидный JSON), получили
+        # fallback-заглушку — её нельзя смешивать с настоящими результатами
+        failed = [r for r in results if r.get("final_verdict") == "Fallback"]
+        if failed and len(failed) == len(results):
+            return dict(failed[0])
+        results = [r for r in results if r.get("final_verdict") != "Fallback"]
+
+        # копия первого блока: результаты блоков уже могли быть отданы клиенту (стриминг)
+        combined = dict(results[0]) if results else {}
+        if failed:
+            # отчёт построен не по всем слайдам: отдаём его, но не кешируем
+            combined["partial"] = True
         if len(results) == 1:
             return combined
 
+        # инициализация ключей если надо (собственные списки, не списки первого блока)
+        for key in ["strengths", "weaknesses", "recommendations"]:
+            combined[key] = list(combined.get(key, []))
+
         for r in results[1:]:
             for key in ["strengths", "weaknesses", "recommendations"]:
-                # инициализация ключей если надо
-                combined.setdefault(key, [])
                 combined[key].extend(r.get(key, []))
             for key in ["clarity_score", "overall_quality_score"]:
                 combined[key] = int(round((combined.get(key, 0) + r.get(key, 0)) / 2))
@@ -180,9 +225,10 @@ class AllTextAnalyzer:
         Для каждого элемента в weaknesses/recommendations:
          - если элемент уже в формате {'slide':N,'text':...} — пропускаем
          - если строка содержит 'Слайд N' — парсим и превращаем в объект
-         - иначе пытаемся найти подходящий слайд(ы) по содержанию (ngram/search)
+         - иначе ищем подходящий слайд(ы) по содержанию в индексе слайдов (n-граммы, затем TF-IDF)
         """
         slides = self._split_into_slides(full_text)  # list of dicts: {'num': int, 'text': str}
+        slide_index = SlideIndex(slides)
         combined = combined.copy()
 
         for key in ("weaknesses", "recommendations"):
@@ -206,7 +252,7 @@ class AllTextAnalyzer:
                     processed.append({"slides": nums, "text": m2.group(2).strip()})
                     continue
                 # 3) пробуем сопоставить по содержанию
-                mapped = self._map_text_to_slides_by_content(s, slides)
+                mapped = slide_index.match(s)
                 if mapped:
                     # mapped — список номеров
                     if len(mapped) == 1:
@@ -279,42 +325,6 @@ class AllTextAnalyzer:
                     continue
         return sorted(set(nums))
 
-    def _map_text_to_slides_by_content(self, text: str, slides: List[Dict[str, Any]]) -> List[int]:
-        """
-        Попытка найти релевантные слайды по содержанию строки:
-         - сначала ищем длинные ngram'ы (6..3 слов),
-         - если не нашли — считаем пересечение значимых слов и выбираем топ-накопитель.
-        Возвращаем список найденных номеров (может быть пуст).
-        """
-        text_l = text.lower()
-        words = [w for w in re.findall(r'\w+', text_l) if len(w) > 2]
-        if not words:
-            return []
-
-        # try n-grams (long to short)
-        for n in range(min(6, len(words)), 2, -1):
-            ngrams = [" ".join(words[i:i+n]) for i in range(0, len(words)-n+1)]
-            for ng in ngrams:
-                for s in slides:
-                    if ng in s["text"]:
-                        return [s["num"]]
-
-        # если ngram не помог — простое совпадение слов
-        scores = []
-        slide_count = len(slides)
-        for s in slides:
-            slide_words = set(re.findall(r'\w+', s["text"]))
-            # count intersection of meaningful words
-            match_count = sum(1 for w in words if w in slide_words)
-            scores.append((s["num"], match_count))
-
-        # берём слайды с положительным совпадением, отсортированные по совпадениям
-        positive = [num for num, cnt in sorted(scores, key=lambda x: -x[1]) if cnt > 0]
-        # если слишком много совпадений — вернём топ-3
-        if positive:
-            return positive[:3]
-        return []
-
     # ---- остальные fallback / вспомогательные методы -----------------------
     def _fallback_summary_from_text(self, raw_text: str, original_text: str) -> Dict[str, Any]:
         return {
@@ -1,8 +1,43 @@
+import asyncio
+import hashlib
 import json
 import re
-from typing import Dict, Any, Optional
-from huggingface_hub import InferenceClient
-from core.config import get_hf_token
+from typing import Dict, Any, List, Optional, Tuple
+from core.config import (get_content_chunk_summary_tokens, get_content_map_reduce, get_llm_block_concurrency,
+                         get_llm_block_timeout)
+from utils.inference_gateway import InferenceGateway, inference_gateway
+from utils.result_cache import make_key, summary_cache
+from utils.token_budget import count_tokens, prompt_budget, clamp_max_tokens
+
+
+# сколько раз конспекты могут сворачиваться повторно, если и они не влезают в контекст
+MAX_REDUCE_LEVELS = 3
+# граница части ставится после слайда, хеш текста которого делится на это число
+# (в среднем столько слайдов в части, если раньше не кончится бюджет токенов)
+CHUNK_BOUNDARY_MODULUS = 8
+
+UNIT_HEADER_RE = re.compile(r'^--- SLIDES? (\d+)(?:–(\d+))? ---\n?')
+# упоминания слайдов в конспекте: «слайд 3», «слайдах 2, 4 и 5», «слайды 6–7»
+SLIDE_REF_RE = re.compile(r'(слайд\w*\s+)(\d+(?:\s*(?:,|–|-|и)\s*\d+)*)', re.IGNORECASE)
+
+
+def _unit_body(unit: str) -> str:
+    """Текст слайда (или конспекта) без заголовка с номером."""
+    return UNIT_HEADER_RE.sub("", unit, count=1).strip()
+
+
+def _is_chunk_boundary(unit: str) -> bool:
+    digest = hashlib.sha256(_unit_body(unit).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % CHUNK_BOUNDARY_MODULUS == 0
+
+
+def _renumber_slide_refs(text: str, numbers: List[int]) -> str:
+    """Переводит номера слайдов внутри части (с 1) в номера слайдов презентации."""
+    def absolute(match: re.Match) -> str:
+        n = int(match.group())
+        return str(numbers[n - 1]) if 1 <= n <= len(numbers) else match.group()
+
+    return SLIDE_REF_RE.sub(lambda m: m.group(1) + re.sub(r'\d+', absolute, m.group(2)), text)
 
 
 class ContentAnalyzer:
@@ -10,28 +45,33 @@ class ContentAnalyzer:
     Анализирует содержание всей презентации.
     Цель: выдавать рекомендации, ключевые моменты, слабые стороны и summary для студентов.
     Вход: текст всех слайдов с разделителями '--- SLIDE N ---'.
+    Длинные презентации, не влезающие в контекст модели, анализируются иерархически:
+    части слайдов параллельно конспектируются (map), итоговый анализ строится по конспектам (reduce).
+    Границы частей определяются содержимым слайдов, а конспекты кешируются по хешу текстов
+    слайдов без номеров, поэтому при правке, вставке или удалении слайда заново
+    конспектируется только затронутая часть.
     """
 
     def __init__(self, model_name, max_tokens, temperature):
-        self.hf_token: Optional[str] = get_hf_token()
-        self.client: Optional[InferenceClient] = None
+        self.client: Optional[InferenceGateway] = None
         self.model_name: str = model_name
         self.models_initialized: bool = False
-        self.max_tokens = max_tokens
+        self.max_tokens = clamp_max_tokens(model_name, max_tokens, "ContentAnalyzer")
         self.temperature = temperature
 
     async def initialize_models(self):
         if self.models_initialized:
             return
         try:
-            self.client = InferenceClient(token=self.hf_token)
+            await inference_gateway.start()
+            self.client = inference_gateway
             self.models_initialized = True
-            print(f"[ContentAnalyzer] InferenceClient ready (model {self.model_name})")
+            print(f"[ContentAnalyzer] InferenceGateway ready (model {self.model_name})")
         except Exception as e:
             print(f"[ContentAnalyzer] init error: {e}")
             self.models_initialized = False
 
-    def analyze_full_content(self, full_text: str) -> Dict[str, Any]:
+    async def analyze_full_content(self, full_text: str) -> Dict[str, Any]:
         """
         Анализ содержания всей презентации. Возвращает словарь с ключевыми полями:
         - main_topic
@@ -44,15 +84,146 @@ class ContentAnalyzer:
         if not self.models_initialized or not self.client:
             return self._fallback_summary(clean_text)
 
-        prompt = self._build_prompt_for_content_analysis(clean_text)
-        raw = self._call_chat_model(prompt, max_tokens=self.max_tokens, temperature=self.temperature)
+        # подсчёт токенов может загрузить токенизатор модели — не блокируем event loop
+        text = clean_text
+        partial = False
+        if await asyncio.to_thread(self._needs_map_reduce, clean_text):
+            text, partial = await self._summarize_chunks(clean_text)
+            if not text:
+                return self._fallback_summary(clean_text)
+
+        prompt = self._build_prompt_for_content_analysis(text)
+        raw = await self._call_chat_model(prompt, max_tokens=self.max_tokens, temperature=self.temperature)
 
         parsed = self._try_parse_json(raw)
         if parsed:
+            if partial:
+                # часть слайдов не вошла в анализ: отчёт отдаём, но не кешируем
+                parsed["partial"] = True
             return parsed
 
         return self._fallback_summary_from_text(raw, clean_text)
 
+    # ---- map-reduce для длинных презентаций --------------------------------
+    def _content_budget(self) -> int:
+        reserved = count_tokens(self._build_prompt_for_content_analysis(""), self.model_name) + 32
+        return prompt_budget(self.model_name, self.max_tokens, reserved)
+
+    def _needs_map_reduce(self, text: str) -> bool:
+        mode = get_content_map_reduce()
+        if mode == "always":
+            return True
+        if mode != "auto":
+            return False
+        return self._exceeds_budget(text)
+
+    def _exceeds_budget(self, text: str) -> bool:
+        return count_tokens(text, self.model_name) > self._content_budget()
+
+    def _make_chunks(self, units: List[str]) -> List[List[str]]:
+        """
+        Делит идущие подряд слайды (или конспекты) на части. Граница ставится после единицы,
+        хеш текста которой делится на CHUNK_BOUNDARY_MODULUS, либо перед единицей, которая
+        не влезает в бюджет. Границы зависят от содержимого, а не от позиции, поэтому
+        изменение одного слайда не сдвигает границы остальных частей.
+        """
+        summary_tokens = get_content_chunk_summary_tokens()
+        reserved = count_tokens(self._build_prompt_for_chunk_summary(""), self.model_name) + 32
+        budget = prompt_budget(self.model_name, summary_tokens, reserved)
+
+        chunks: List[List[str]] = []
+        current: List[str] = []
+        used = 0
+        for unit in units:
+            cost = count_tokens(unit, self.model_name) + 2
+            if current and used + cost > budget:
+                chunks.append(current)
+                current, used = [], 0
+            current.append(unit)
+            used += cost
+            if _is_chunk_boundary(unit):
+                chunks.append(current)
+                current, used = [], 0
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def _summarize_chunks(self, clean_text: str) -> Tuple[str, bool]:
+        """
+        Сворачивает текст до конспектов частей, пока он не влезет в бюджет итогового запроса.
+        Первый уровень — целые слайды, следующие (если понадобятся) — уже конспекты.
+        Возвращает (текст, partial): partial — конспект хотя бы одной части не получен
+        (таймаут или ошибка модели), и эти слайды в текст не попали.
+        """
+        units = [u.strip() for u in re.split(r'(?=--- SLIDE \d+ ---)', clean_text) if u.strip()]
+        text = clean_text
+        partial = False
+        for _ in range(MAX_REDUCE_LEVELS):
+            chunks = await asyncio.to_thread(self._make_chunks, units)
+            semaphore = asyncio.Semaphore(get_llm_block_concurrency())
+            summaries = await asyncio.gather(*(self._summarize_chunk(chunk, semaphore) for chunk in chunks))
+            units = [summary for summary in summaries if summary]
+            partial = partial or len(units) < len(summaries)
+            if not units:
+                return "", partial
+            text = "\n\n".join(units)
+            if len(chunks) == 1 or not await asyncio.to_thread(self._exceeds_budget, text):
+                break
+        return text, partial
+
+    async def _summarize_chunk(self, units: List[str], semaphore: asyncio.Semaphore) -> str:
+        summary_tokens = get_content_chunk_summary_tokens()
+        # заголовки слайдов ('--- SLIDE N ---') или уже свёрнутых конспектов ('--- SLIDES N–M ---')
+        headers = [UNIT_HEADER_RE.match(unit) for unit in units]
+        slide_numbers = [int(h.group(1)) for h in headers if h and h.group(2) is None]
+        if len(slide_numbers) == len(units):
+            # часть из слайдов: модель видит номера внутри части (с 1), в ключ кеша идут только
+            # тексты слайдов, а номера в презентации подставляются после обращения к кешу
+            bodies = [_unit_body(unit) for unit in units]
+            chunk = "\n\n".join(f"--- SLIDE {i} ---\n{body}" for i, body in enumerate(bodies, start=1))
+            key_source = bodies
+        else:
+            slide_numbers = []
+            chunk = "\n\n".join(units)
+            key_source = units
+
+        chunk_hash = hashlib.sha256(json.dumps(key_source, ensure_ascii=False).encode("utf-8")).hexdigest()
+        cache_key = make_key(chunk_hash, 'content_chunk_summary', model_name=self.model_name,
+                             max_tokens=summary_tokens)
+        summary = await asyncio.to_thread(summary_cache.get, cache_key)
+        if summary is None:
+            async with semaphore:
+                try:
+                    summary = await asyncio.wait_for(
+                        self._call_chat_model(self._build_prompt_for_chunk_summary(chunk), max_tokens=summary_tokens,
+                                              temperature=0.0, stop_on_json=False),
+                        timeout=get_llm_block_timeout()
+                    )
+                except asyncio.TimeoutError:
+                    print("[ContentAnalyzer] chunk summary timeout")
+                    return ""
+            if not summary:
+                return ""
+            await asyncio.to_thread(summary_cache.set, cache_key, summary)
+
+        if slide_numbers:
+            summary = _renumber_slide_refs(summary, slide_numbers)
+        # номера слайдов в заголовке конспекта, чтобы итоговые недочёты ссылались на слайды
+        ranges = [(h.group(1), h.group(2) or h.group(1)) for h in headers if h]
+        header = f"--- SLIDES {ranges[0][0]}–{ranges[-1][1]} ---" if ranges else "--- PART ---"
+        return f"{header}\n{summary}"
+
+    def _build_prompt_for_chunk_summary(self, text: str) -> str:
+        instruction = (
+            "Ты — преподаватель и эксперт по обучающим презентациям. "
+            "Ниже — часть презентации, разделённая слайдами '--- SLIDE N ---'.\n"
+            "Составь сжатый конспект этой части: основные идеи, определения и выводы, "
+            "а также замеченные ошибки, противоречия и пробелы в изложении с номерами слайдов.\n"
+            "Ссылаясь на слайд, пиши «слайд N», где N — номер из заголовка '--- SLIDE N ---'.\n"
+            "Пиши связным текстом на русском языке, без markdown и JSON."
+        )
+        return instruction + "\n\n" + text
+
     def _build_prompt_for_content_analysis(self, text: str) -> str:
         """
         Формируем промт для анализа содержания:
@@ -62,7 +233,8 @@ class ContentAnalyzer:
         """
         instruction = (
             "Ты — преподаватель и эксперт по обучающим презентациям. "
-            "Проанализируй текст всей презентации, разделённый слайдами '--- SLIDE N ---'.\n"
+            "Проанализируй текст всей презентации, разделённый слайдами '--- SLIDE N ---' "
+            "(для длинных презентаций — конспекты частей '--- SLIDES N–M ---').\n"
             "Верни строго JSON со следующей схемой:\n"
             "{\n"
             '  "main_topic": string,  # основная тема презентации\n'
@@ -75,31 +247,19 @@ class ContentAnalyzer:
         )
         return instruction + "\n\n" + text
 
-    def _call_chat_model(self, prompt: str, max_tokens: int = 800, temperature: float = 0.0) -> str:
+    async def _call_chat_model(self, prompt: str, max_tokens: int = 800, temperature: float = 0.0,
+                               stop_on_json: bool = True) -> str:
         if not self.client:
             return ""
         try:
-            response = self.client.chat_completion(
+            text_out = await self.client.chat(
                 model=self.model_name,
                 messages=[{"role": "user", "content": prompt}],
                 max_tokens=max_tokens,
                 temperature=temperature,
                 top_p=0.9,
+                stop_on_json=stop_on_json,
             )
-            text_out = ""
-            if isinstance(response, dict):
-                choices = response.get("choices") or response.get("outputs")
-                if choices and isinstance(choices, list) and len(choices) > 0:
-                    first = choices[0]
-                    msg = first.get("message") or first
-                    if isinstance(msg, dict):
-                        text_out = msg.get("content") or msg.get("text") or ""
-                    else:
-                        text_out = str(first)
-                else:
-                    text_out = response.get("generated_text", "") or response.get("text", "") or ""
-            else:
-                text_out = str(response)
             return self._clean_response(text_out)
         except Exception as e:
             print(f"[ContentAnalyzer] LLM call error: {e}")
@@ -1,14 +1,101 @@
-from typing import List
-import numpy as np
-from sentence_transformers import SentenceTransformer
+import os
+import threading
+from typing import List, Optional
+
+from core.config import (get_embedding_engine, get_embedding_onnx_dir, get_embedding_onnx_threads,
+                         get_embedding_onnx_max_batch_tokens, get_embedding_onnx_min_cosine)
 
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
-embedder = SentenceTransformer(MODEL_NAME)
+EMBEDDING_DIM = 384
+
+# фразы для сверки ONNX-движка с эталоном на torch
+VERIFY_SENTENCES = [
+    "Слайд перегружен текстом, уменьшите количество пунктов.",
+    "Каждый слайд должен содержать один главный тезис.",
+    "Используйте контрастные цвета для заголовков и основного текста.",
+    "The presentation should end with a clear summary of key points.",
+    "Графики подписываются, оси имеют единицы измерения.",
+]
+
+# модель (и torch вместе с sentence_transformers) загружается при первом обращении,
+# а не при импорте, чтобы не задерживать старт процесса
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def _load_torch():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(MODEL_NAME)
+
+
+def _load_onnx():
+    """
+    ONNX-движок с int8-весами: (движок или None, эталонная torch-модель или None).
+    При EMBEDDING_ONNX_MIN_COSINE > 0 эмбеддинги ONNX один раз, после экспорта, сверяются
+    с torch на VERIFY_SENTENCES, и результат сохраняется рядом с моделью. Если совпадение
+    ниже порога, движок не используется, а уже загруженная для сверки torch-модель
+    возвращается, чтобы не загружать её второй раз.
+    """
+    from utils.onnx_embedder import OnnxEmbedder, cosine_agreement, load_agreement, save_agreement
+
+    directory = os.path.join(get_embedding_onnx_dir(), MODEL_NAME.replace("/", "__"))
+    min_cosine = get_embedding_onnx_min_cosine()
+    agreement = load_agreement(directory)
+    if min_cosine > 0 and agreement is not None and agreement < min_cosine:
+        print(f"[embedding] ONNX int8 vs torch cosine agreement: {agreement:.4f} (saved)")
+        return None, None
+
+    embedder = OnnxEmbedder(
+        MODEL_NAME, directory,
+        threads=get_embedding_onnx_threads(), max_batch_tokens=get_embedding_onnx_max_batch_tokens()
+    )
+    if min_cosine <= 0:
+        return embedder, None
+
+    reference = None
+    # конструктор мог заново экспортировать модель — тогда прежний результат сверки удалён
+    agreement = load_agreement(directory)
+    if agreement is None:
+        reference = _load_torch()
+        agreement = cosine_agreement(embedder.encode(VERIFY_SENTENCES),
+                                     reference.encode(VERIFY_SENTENCES, normalize_embeddings=True))
+        try:
+            save_agreement(directory, agreement)
+        except OSError as e:
+            print(f"[embedding] could not save ONNX verification: {e}")
+        print(f"[embedding] ONNX int8 vs torch cosine agreement: {agreement:.4f}")
+    if agreement < min_cosine:
+        return None, reference
+    return embedder, None
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                engine = reference = None
+                if get_embedding_engine() == "onnx":
+                    try:
+                        engine, reference = _load_onnx()
+                        if engine is None:
+                            print("[embedding] ONNX engine disagrees with torch, falling back to torch")
+                    except Exception as e:
+                        print(f"[embedding] ONNX engine unavailable, falling back to torch: {e}")
+                _embedder = engine or reference or _load_torch()
+                print(f"[embedding] {MODEL_NAME} loaded ({type(_embedder).__name__})")
+    return _embedder
+
+
+def is_loaded() -> bool:
+    return _embedder is not None
+
 
 def embed_text(text: str) -> List[float]:
-    vec = embedder.encode(text, normalize_embeddings=True)
+    vec = get_embedder().encode(text, normalize_embeddings=True)
     return vec.tolist()
 
-def embed_texts(texts: List[str]) -> List[List[float]]:
-    vectors = embedder.encode(texts, normalize_embeddings=True)
+
+def embed_texts(texts: List[str], batch_size: Optional[int] = None) -> List[List[float]]:
+    vectors = get_embedder().encode(texts, batch_size=batch_size or 32, normalize_embeddings=True)
     return vectors.tolist()
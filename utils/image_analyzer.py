@@ -1,24 +1,52 @@
 
+import asyncio
 import json
-import io
 import re
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, AsyncIterable, AsyncIterator, Tuple, Union
 from PIL import Image
-from huggingface_hub import InferenceClient
 
 
-from core.config import get_hf_token
+from core.config import (get_render_window_size, get_vlm_concurrency, get_vlm_caption_timeout,
+                         get_vlm_models_list)
+from utils.image_encoding import encode_for_vlm, image_options_for_model
+from utils.inference_gateway import InferenceGateway, inference_gateway
+from utils.layout_metrics import compute_layout_metrics
+from utils.result_cache import caption_cache, make_key
+from utils.slide_dedup import SlideDeduplicator, image_fingerprint
+
+
+# Ограничение одновременных запросов к каждой VLM-модели общее для всех запросов процесса
+_caption_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _get_caption_semaphore(model_name: str) -> asyncio.Semaphore:
+    semaphore = _caption_semaphores.get(model_name)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(get_vlm_concurrency())
+        _caption_semaphores[model_name] = semaphore
+    return semaphore
+
+
+async def _iter_slides(slide_images: Union[Iterable[Image.Image], AsyncIterable[Image.Image]]) -> AsyncIterator[Image.Image]:
+    if hasattr(slide_images, "__aiter__"):
+        async for img in slide_images:
+            yield img
+    else:
+        for img in slide_images:
+            yield img
 
 
 class ImageAnalyzer:
 
     def __init__(self, model_name):
-        self.hf_token: Optional[str] = get_hf_token()
-        self.vlm_client: Optional[InferenceClient] = None
-        self.llm_client: Optional[InferenceClient] = None
+        self.vlm_client: Optional[InferenceGateway] = None
+        self.llm_client: Optional[InferenceGateway] = None
 
         self.caption_model = model_name
         self.reasoning_model = "IlyaGusev/saiga_llama3_8b"
+        self.image_options = image_options_for_model(
+            next((m for m in get_vlm_models_list() if m.get('model_name') == model_name), None)
+        )
 
         self.models_initialized = False
 
@@ -26,70 +54,151 @@ class ImageAnalyzer:
         if self.models_initialized:
             return
         try:
-            self.vlm_client = InferenceClient(model=self.caption_model, token=self.hf_token)
-            self.llm_client = InferenceClient(token=self.hf_token)
+            await inference_gateway.start()
+            self.vlm_client = inference_gateway
+            self.llm_client = inference_gateway
             self.models_initialized = True
-            print(f"[ImageAnalyzer] InferenceClient ready (model {self.caption_model})")
+            print(f"[ImageAnalyzer] InferenceGateway ready (model {self.caption_model})")
         except Exception as e:
             print(f"[ImageAnalyzer] init error: {e}")
             self.models_initialized = False
 
-    async def analyze_visual_presentation(self, slide_images: List[Image.Image]) -> Dict[str, Any]:
+    async def analyze_visual_presentation(self, slide_images: Union[Iterable[Image.Image], AsyncIterable[Image.Image]],
+                                          window_size: Optional[int] = None) -> Dict[str, Any]:
+        """
+        slide_images может быть списком или ленивым генератором, в том числе асинхронным
+        (PdfDocument.aiter_images — рендеринг не блокирует цикл событий).
+        В работе одновременно не больше window_size слайдов: следующий слайд запрашивается
+        у генератора только когда один из текущих обработан и освобождён, поэтому пиковая
+        память зависит от размера окна, а не от количества слайдов.
+        Подписи внутри окна запрашиваются параллельно (не больше VLM_CONCURRENCY на модель);
+        для почти одинаковых слайдов (по dHash) подпись запрашивается один раз и
+        переиспользуется, а сам слайд помечается полем duplicate_of.
+        """
+        report = self._fallback()
+        async for event in self.iter_visual_presentation(slide_images, window_size):
+            if event["event"] == "report":
+                report = event["data"]
+        return report
+
+    async def iter_visual_presentation(self, slide_images: Union[Iterable[Image.Image], AsyncIterable[Image.Image]],
+                                       window_size: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        То же, что analyze_visual_presentation, но по шагам: событие "slide" (подпись и метрики)
+        отдаётся, как только слайд обработан (в порядке готовности), затем событие "report".
+        """
 
         if not self.models_initialized:
-            return self._fallback()
+            yield {"event": "report", "data": self._fallback()}
+            return
+
+        window_size = window_size or get_render_window_size()
+        slide_results: Dict[int, Dict[str, Any]] = {}
+        captions: Dict[int, asyncio.Task] = {}
+        dedup = SlideDeduplicator()
+        pending = set()
+        slides = _iter_slides(slide_images)
+
+        try:
+            idx = 0
+            async for img in slides:
+                idx += 1
+                if len(pending) >= window_size:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for event in self._slide_events(done, slide_results):
+                        yield event
+                # почти одинаковые слайды (шаги анимации) подписываются один раз;
+                # dHash считается в потоке, чтобы не блокировать цикл событий
+                duplicate_of = await asyncio.to_thread(dedup.assign, idx, img)
+                if duplicate_of is None:
+                    captions[idx] = asyncio.create_task(self._caption(img))
+                pending.add(asyncio.create_task(
+                    self._analyze_slide(idx, img, captions[duplicate_of or idx], duplicate_of)
+                ))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for event in self._slide_events(done, slide_results):
+                    yield event
+        finally:
+            # клиент отключился или анализ прерван — не оставляем висящих запросов к VLM
+            for task in list(pending) + list(captions.values()):
+                task.cancel()
+            # останавливаем и источник слайдов: его фоновый рендеринг следующего окна больше не нужен
+            await slides.aclose()
+
+        ordered = [slide_results[idx] for idx in sorted(slide_results)]
+        prompt = self._build_global_prompt(ordered)
+        raw = await self._call_llm(prompt)
+        parsed = self._try_parse_json(raw)
+
+        yield {"event": "report", "data": parsed or self._fallback()}
 
-        slide_results = []
+    def _slide_events(self, done, slide_results: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        events = []
+        for task in done:
+            info = task.result()
+            slide_results[info["slide_number"]] = info
+            events.append({"event": "slide", "data": info})
+        return sorted(events, key=lambda e: e["data"]["slide_number"])
 
-        for idx, img in enumerate(slide_images, start=1):
-            info = {"slide_number": idx}
+    async def _analyze_slide(self, idx: int, img: Image.Image, caption: asyncio.Task,
+                             duplicate_of: Optional[int] = None) -> Dict[str, Any]:
+        info = {"slide_number": idx}
 
+        try:
             try:
-                info["caption"] = self._caption(img)
+                info["caption"] = await asyncio.shield(caption)
+            except asyncio.CancelledError:
+                raise
             except:
                 info["caption"] = ""
+            if duplicate_of is not None:
+                info["duplicate_of"] = duplicate_of
 
-            stats = self._estimate_text_density(img)
+            stats = await asyncio.to_thread(self._layout_metrics, img)
             info.update(stats)
-
-            if info["text_coverage"] > 0.35:
-                info["slide_type"] = "text_heavy"
-            elif info["text_coverage"] < 0.08:
-                info["slide_type"] = "image_heavy"
-            else:
-                info["slide_type"] = "balanced"
-
-            slide_results.append(info)
-
-        prompt = self._build_global_prompt(slide_results)
-        raw = self._call_llm(prompt)
-        parsed = self._try_parse_json(raw)
-
-        if parsed:
-            return parsed
-
-        return self._fallback()
-
-    def _caption(self, img: Image.Image) -> str:
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
+        finally:
+            img.close()
+
+        if info["text_coverage"] > 0.35:
+            info["slide_type"] = "text_heavy"
+        elif info["text_coverage"] < 0.08:
+            info["slide_type"] = "image_heavy"
+        else:
+            info["slide_type"] = "balanced"
+
+        return info
+
+    async def _caption(self, img: Image.Image) -> str:
+        # кеш подписей проверяется до кодирования изображения и сетевого запроса;
+        # отпечаток изображения и чтение кеша с диска — в потоке
+        cache_key, cached = await asyncio.to_thread(self._cached_caption, img)
+        if cached is not None:
+            return cached
+
+        data = await asyncio.to_thread(encode_for_vlm, img, **self.image_options)
         try:
-            resp = self.vlm_client.image_to_text(buf)
-            return resp.get("generated_text", "").strip()
-        except:
+            async with _get_caption_semaphore(self.caption_model):
+                caption = await asyncio.wait_for(self.vlm_client.image_to_text(self.caption_model, data),
+                                                 timeout=get_vlm_caption_timeout())
+            caption = caption.strip()
+            if caption:
+                await asyncio.to_thread(caption_cache.set, cache_key, caption)
+            return caption
+        except asyncio.TimeoutError:
+            print(f"[ImageAnalyzer] caption timeout ({self.caption_model})")
+            return ""
+        except Exception as e:
+            # CancelledError не перехватываем: отменённая подпись должна отмениться
+            print(f"[ImageAnalyzer] caption error: {e}")
             return ""
 
-    def _estimate_text_density(self, img: Image.Image) -> Dict[str, float]:
-        gray = img.convert("L")
-        hist = gray.histogram()
-        dark = sum(hist[:70])
-        total = sum(hist)
-        density = dark / total if total else 0
-        coverage = min(1.0, density * 1.8)
-        return {"text_density": round(density, 4), "text_coverage": round(coverage, 4)}
-
+    def _cached_caption(self, img: Image.Image) -> Tuple[str, Optional[str]]:
+        cache_key = make_key(image_fingerprint(img), self.caption_model)
+        return cache_key, caption_cache.get(cache_key)
 
+    def _layout_metrics(self, img: Image.Image) -> Dict[str, Any]:
+        return compute_layout_metrics(img)
 
     def _build_global_prompt(self, slides: List[Dict[str, Any]]) -> str:
         example_json = {
@@ -106,6 +215,10 @@ class ImageAnalyzer:
             "Анализируй только визуальные характеристики слайдов (не текст и не смысл).\n"
             "Всегда возвращай ответ в формате JSON, ключи оставляй английскими, "
             "а текст внутри всех полей — строго на русском языке.\n\n"
+            "Метрики слайдов: text_coverage — доля текста/тёмных элементов, edge_density — доля резких "
+            "перепадов (текст, линии), whitespace_ratio — доля пустого фона, contrast — контраст (0..1), "
+            "region_grid — заполненность сетки 3x3 (строки сверху вниз, 0..1), "
+            "duplicate_of — номер почти такого же слайда (шаг анимации или повтор).\n\n"
             "Данные по слайдам:\n"
             f"{json.dumps(slides, ensure_ascii=False)}\n\n"
             "Пример правильного JSON-ответа:\n"
@@ -114,23 +227,18 @@ class ImageAnalyzer:
         )
 
 
-    def _call_llm(self, prompt: str) -> str:
+    async def _call_llm(self, prompt: str) -> str:
         try:
-            resp = self.llm_client.chat_completion(
+            return await self.llm_client.chat(
                 model=self.reasoning_model,
                 messages=[
                     {"role": "system", "content": "Ты — эксперт по визуальному анализу презентаций. Всегда отвечай на русском языке. Формат ответа — строго JSON."},
                     {"role": "user", "content": prompt}
                 ],
                 max_tokens=1500,
-                temperature=0.0
+                temperature=0.0,
+                stop_on_json=True
             )
-            if isinstance(resp, dict):
-                ch = resp.get("choices") or resp.get("outputs")
-                if ch:
-                    msg = ch[0].get("message") or ch[0]
-                    return msg.get("content") if isinstance(msg, dict) else str(msg)
-            return str(resp)
         except Exception as e:
             print(f"[ImageAnalyzer] LLM error: {e}")
             return ""
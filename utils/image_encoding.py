@@ -0,0 +1,63 @@
+import io
+from typing import Optional, Dict, Any
+
+from PIL import Image
+
+from core.config import get_vlm_image_max_bytes
+
+
+DEFAULT_MAX_SIDE = 1024
+DEFAULT_FORMAT = "JPEG"
+DEFAULT_QUALITY = 85
+MIN_QUALITY = 50
+QUALITY_STEP = 10
+DOWNSCALE_STEP = 0.75
+MAX_ATTEMPTS = 8
+
+
+def image_options_for_model(model_entry: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Параметры подготовки изображения из записи vlm_models_list (с значениями по умолчанию)."""
+    model_entry = model_entry or {}
+    return {
+        "max_side": model_entry.get("max_image_side", DEFAULT_MAX_SIDE),
+        "fmt": model_entry.get("image_format", DEFAULT_FORMAT),
+        "quality": model_entry.get("image_quality", DEFAULT_QUALITY),
+    }
+
+
+def _downscale(img: Image.Image, max_side: int) -> Image.Image:
+    longest = max(img.size)
+    if not max_side or longest <= max_side:
+        return img
+    ratio = max_side / longest
+    size = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+    return img.resize(size, Image.BICUBIC, reducing_gap=2.0)
+
+
+def encode_for_vlm(img: Image.Image, max_side: int = DEFAULT_MAX_SIDE, fmt: str = DEFAULT_FORMAT,
+                   quality: int = DEFAULT_QUALITY, max_bytes: Optional[int] = None) -> bytes:
+    """
+    Готовит слайд к отправке в VLM: уменьшает до max_side по длинной стороне и кодирует
+    в JPEG/WebP. Если результат больше max_bytes — сначала снижается качество
+    (не ниже MIN_QUALITY), затем уменьшается разрешение.
+    Возвращается последний вариант, даже если уложиться в бюджет не удалось.
+    """
+    max_bytes = get_vlm_image_max_bytes() if max_bytes is None else max_bytes
+    fmt = fmt.upper()
+    prepared = _downscale(img.convert("RGB") if img.mode != "RGB" else img, max_side)
+
+    data = b""
+    for _ in range(MAX_ATTEMPTS):
+        buf = io.BytesIO()
+        if fmt == "PNG":
+            prepared.save(buf, format="PNG", optimize=False, compress_level=6)
+        else:
+            prepared.save(buf, format=fmt, quality=quality)
+        data = buf.getvalue()
+        if not max_bytes or len(data) <= max_bytes:
+            break
+        if fmt != "PNG" and quality - QUALITY_STEP >= MIN_QUALITY:
+            quality -= QUALITY_STEP
+        else:
+            prepared = _downscale(prepared, int(max(prepared.size) * DOWNSCALE_STEP))
+    return data
@@ -0,0 +1,125 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from huggingface_hub import AsyncInferenceClient
+
+from core.config import (get_hf_token, get_inference_max_concurrency, get_inference_timeout, get_llm_model_entry,
+                         get_llm_stream_early_stop)
+from utils.json_stream import JsonObjectScanner
+from utils.llm_cache import llm_cache
+from utils.local_backend import local_backend
+
+
+def extract_chat_text(response: Any) -> str:
+    """Достаёт текст ответа из chat_completion (ChatCompletionOutput, dict или строка)."""
+    if isinstance(response, dict):
+        choices = response.get("choices") or response.get("outputs")
+        if choices and isinstance(choices, list) and len(choices) > 0:
+            first = choices[0]
+            msg = first.get("message") or first
+            if isinstance(msg, dict):
+                return msg.get("content") or msg.get("text") or ""
+            return str(first)
+        return response.get("generated_text", "") or response.get("text", "") or ""
+    return str(response)
+
+
+class InferenceGateway:
+    """
+    Единый на процесс асинхронный клиент HF Inference для всех анализаторов.
+    Создаётся при старте приложения и закрывается при остановке, поэтому
+    HTTP-сессия (keep-alive соединения, TLS) переиспользуется между запросами,
+    а общее число одновременных запросов ограничено INFERENCE_MAX_CONCURRENCY.
+    LLM с 'backend': 'local' в llm_models_list обслуживаются локально (local_backend), без сети.
+    При stop_on_json ответ читается потоком и генерация обрывается, как только модель
+    закончила JSON-объект (LLM_STREAM_EARLY_STOP), — болтовня после ответа не генерируется.
+    """
+
+    def __init__(self):
+        self.client: Optional[AsyncInferenceClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.client is not None
+
+    async def start(self) -> None:
+        if self.client is not None:
+            return
+        self.client = AsyncInferenceClient(token=get_hf_token(), timeout=get_inference_timeout())
+        self._semaphore = asyncio.Semaphore(get_inference_max_concurrency())
+        print("[InferenceGateway] AsyncInferenceClient ready")
+
+    async def close(self) -> None:
+        await local_backend.close()
+        client, self.client = self.client, None
+        if client is not None and hasattr(client, "close"):
+            try:
+                await client.close()
+            except Exception as e:
+                print(f"[InferenceGateway] close error: {e}")
+
+    async def chat(self, model: str, messages: List[Dict[str, str]], max_tokens: int,
+                   temperature: float, top_p: Optional[float] = None, stop_on_json: bool = False) -> str:
+        cache_key = None
+        if llm_cache.should_cache(temperature):
+            cache_key = llm_cache.make_key(model, messages, max_tokens, temperature, top_p)
+            cached = await llm_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        stop_on_json = stop_on_json and get_llm_stream_early_stop()
+        if (get_llm_model_entry(model) or {}).get('backend') == 'local':
+            text = await local_backend.chat(model, messages, max_tokens, temperature, top_p, stop_on_json)
+        else:
+            await self.start()
+            async with self._semaphore:
+                if stop_on_json:
+                    text = await self._stream_until_json(model, messages, max_tokens, temperature, top_p)
+                else:
+                    response = await self.client.chat_completion(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        top_p=top_p,
+                    )
+                    text = extract_chat_text(response)
+        if cache_key and text:
+            await llm_cache.set(cache_key, model, text)
+        return text
+
+    async def _stream_until_json(self, model: str, messages: List[Dict[str, str]], max_tokens: int,
+                                 temperature: float, top_p: Optional[float]) -> str:
+        """Читает ответ потоком; закрывает поток (и соединение) сразу после завершения JSON-объекта."""
+        scanner = JsonObjectScanner()
+        stream = await self.client.chat_completion(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stream=True,
+        )
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                if scanner.feed(chunk.choices[0].delta.content or ""):
+                    break
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        return scanner.object_text if scanner.done else scanner.text
+
+    async def image_to_text(self, model: str, image: bytes) -> str:
+        await self.start()
+        async with self._semaphore:
+            response = await self.client.image_to_text(image, model=model)
+        if isinstance(response, dict):
+            return response.get("generated_text", "") or ""
+        return getattr(response, "generated_text", "") or ""
+
+
+inference_gateway = InferenceGateway()
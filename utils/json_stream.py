@@ -0,0 +1,84 @@
+import json
+from typing import Optional
+
+
+class JsonObjectScanner:
+    """
+    Инкрементальный поиск первого JSON-объекта верхнего уровня в потоке текста модели.
+    Текст подаётся кусками (feed), каждый символ просматривается один раз; учитываются
+    строки и экранирование, поэтому скобки внутри значений не сбивают счёт вложенности.
+    Объект считается готовым, когда закрылась его внешняя скобка и он разбирается json.loads;
+    если не разбирается — поиск продолжается со следующей '{'.
+    Преамбула (```json и т.п.) перед объектом допускается.
+    """
+
+    def __init__(self):
+        self.text: str = ""
+        self.start: Optional[int] = None
+        self.end: Optional[int] = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def done(self) -> bool:
+        return self.end is not None
+
+    @property
+    def object_text(self) -> Optional[str]:
+        return self.text[self.start:self.end] if self.done else None
+
+    def feed(self, chunk: str) -> bool:
+        """Добавляет кусок текста; True, как только объект верхнего уровня завершён и валиден."""
+        if self.done:
+            return True
+        self.text += chunk
+        text = self.text
+        i = self._pos
+        while i < len(text):
+            ch = text[i]
+            i += 1
+            if self.start is None:
+                if ch == '{':
+                    self.start, self._depth = i - 1, 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    if self._is_valid(text[self.start:i]):
+                        self.end = self._pos = i
+                        return True
+                    # скобки сошлись, но это не JSON — ищем следующий объект
+                    i, self.start = self.start + 1, None
+        self._pos = i
+        return False
+
+    def _is_valid(self, candidate: str) -> bool:
+        try:
+            return isinstance(json.loads(candidate), dict)
+        except ValueError:
+            return False
+
+
+def cut_after_json(text: str) -> str:
+    """
+    Оставляет от ответа только первый валидный JSON-объект: без преамбулы (```json и т.п.)
+    и без всего, что модель дописала после него. Если объекта нет — ответ возвращается как есть.
+    """
+    scanner = JsonObjectScanner()
+    if scanner.feed(text):
+        return scanner.object_text
+    return text
@@ -0,0 +1,71 @@
+from typing import Dict, Any
+
+import numpy as np
+from PIL import Image
+
+
+# Метрики считаются по слайду, приведённому к одному размеру: стоимость не зависит от DPI
+# рендеринга, а пороги и сетка одинаковы для всех слайдов. NEAREST не усредняет пиксели,
+# поэтому распределение яркости (и доля тёмных пикселей) сохраняется таким же, как у исходного изображения.
+METRICS_WIDTH = 480
+METRICS_HEIGHT = 270
+GRID_ROWS = 3
+GRID_COLS = 3
+
+DARK_THRESHOLD = 70        # порог «тёмного» пикселя, как в прежней оценке по гистограмме
+EDGE_THRESHOLD = 40        # перепад яркости между соседними пикселями, считающийся границей
+BACKGROUND_TOLERANCE = 12  # отклонение от цвета фона, которое ещё считается пустым местом
+CONTENT_THRESHOLD = 24     # отклонение от фона, начиная с которого пиксель считается содержимым
+
+
+def to_gray_array(img: Image.Image) -> np.ndarray:
+    small = img.resize((METRICS_WIDTH, METRICS_HEIGHT), Image.NEAREST)
+    return np.asarray(small.convert("L"), dtype=np.uint8)
+
+
+def compute_layout_metrics(img: Image.Image) -> Dict[str, Any]:
+    """
+    Метрики компоновки слайда, векторно по массиву яркости (H, W):
+    - text_density / text_coverage — доля тёмных пикселей (как раньше);
+    - edge_density — доля пикселей на резких перепадах яркости (текст, линии, рамки);
+    - whitespace_ratio — доля пикселей цвета фона (фон — самая частая яркость слайда);
+    - contrast — RMS-контраст;
+    - region_grid — заполненность содержимым каждой ячейки сетки 3x3.
+    """
+    gray = to_gray_array(img)
+    h, w = gray.shape
+    pixels = h * w
+
+    hist = np.bincount(gray.ravel(), minlength=256)
+    cumulative = hist.cumsum()
+
+    density = cumulative[DARK_THRESHOLD - 1] / pixels
+    coverage = min(1.0, density * 1.8)
+
+    background = int(hist.argmax())
+    lo = max(background - BACKGROUND_TOLERANCE, 0)
+    hi = min(background + BACKGROUND_TOLERANCE, 255)
+    below = cumulative[lo - 1] if lo > 0 else 0
+    whitespace = (cumulative[hi] - below) / pixels
+
+    signed = gray.astype(np.int16)
+    dx = np.abs(np.diff(signed, axis=1))[:-1, :]
+    dy = np.abs(np.diff(signed, axis=0))[:, :-1]
+    edges = np.maximum(dx, dy) > EDGE_THRESHOLD
+    edge_density = edges.mean()
+
+    contrast = signed.std() / 255.0
+
+    content = np.abs(signed - background) > CONTENT_THRESHOLD
+    cell_h, cell_w = h // GRID_ROWS, w // GRID_COLS
+    content = content[:cell_h * GRID_ROWS, :cell_w * GRID_COLS]
+    grid = content.reshape(GRID_ROWS, cell_h, GRID_COLS, cell_w).mean(axis=(1, 3))
+
+    return {
+        "text_density": round(float(density), 4),
+        "text_coverage": round(float(coverage), 4),
+        "edge_density": round(float(edge_density), 4),
+        "whitespace_ratio": round(float(whitespace), 4),
+        "contrast": round(float(contrast), 4),
+        "region_grid": np.round(grid, 2).tolist(),
+    }
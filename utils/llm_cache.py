@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from core.config import (get_llm_cache_enabled, get_llm_cache_max_items, get_llm_cache_sqlite_path,
+                         get_llm_cache_sqlite_max_rows, get_llm_cache_nonzero_temperature)
+
+
+PRUNE_EVERY = 100
+
+
+class LLMResponseCache:
+    """
+    Мемоизация ответов chat-моделей по (модель, хеш сообщений, max_tokens, temperature, top_p).
+    Память — LRU на LLM_CACHE_MAX_ITEMS ответов; при заданном LLM_CACHE_SQLITE_PATH ответы
+    дополнительно сохраняются в SQLite и переживают перезапуск.
+    get/set асинхронные: LRU проверяется прямо в цикле событий, а запросы и commit
+    SQLite выполняются в потоке.
+    При temperature > 0 ответ недетерминирован, поэтому кеш обходится,
+    если явно не включён LLM_CACHE_NONZERO_TEMPERATURE.
+    """
+
+    def __init__(self, enabled: Optional[bool] = None, max_items: Optional[int] = None,
+                 sqlite_path: Optional[str] = None):
+        self.enabled: bool = get_llm_cache_enabled() if enabled is None else enabled
+        self.max_items: int = get_llm_cache_max_items() if max_items is None else max_items
+        self.sqlite_path: Optional[str] = get_llm_cache_sqlite_path() if sqlite_path is None else sqlite_path
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        # соединение SQLite используется из потоков asyncio.to_thread — по одному запросу за раз
+        self._db_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._writes = 0
+
+    def should_cache(self, temperature: float) -> bool:
+        return self.enabled and (not temperature or get_llm_cache_nonzero_temperature())
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, str]], max_tokens: int, temperature: float,
+                 top_p: Optional[float]) -> str:
+        messages_hash = hashlib.sha256(
+            json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        payload = json.dumps([model, messages_hash, max_tokens, temperature, top_p])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+
+        if text is None and self.sqlite_path:
+            text = await asyncio.to_thread(self._db_get, key)
+
+        with self._lock:
+            if text is not None:
+                self._remember(key, text)
+                self.hits += 1
+            else:
+                self.misses += 1
+        return text
+
+    async def set(self, key: str, model: str, text: str) -> None:
+        with self._lock:
+            self._remember(key, text)
+        if self.sqlite_path:
+            await asyncio.to_thread(self._db_set, key, model, text)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "memory_items": len(self._memory),
+                "sqlite": bool(self.sqlite_path),
+            }
+
+    # ---- память -------------------------------------------------------------
+    def _remember(self, key: str, text: str) -> None:
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    # ---- SQLite -------------------------------------------------------------
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if not self.sqlite_path:
+            return None
+        if self._db is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.sqlite_path)), exist_ok=True)
+                db = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_responses ("
+                    "key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, used REAL)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS llm_responses_used ON llm_responses (used)")
+                db.commit()
+                self._db = db
+            except sqlite3.Error as e:
+                print(f"[LLMResponseCache] sqlite unavailable: {e}")
+                self.sqlite_path = None
+                return None
+        return self._db
+
+    def _db_get(self, key: str) -> Optional[str]:
+        with self._db_lock:
+            return self._db_get_locked(key)
+
+    def _db_get_locked(self, key: str) -> Optional[str]:
+        db = self._connection()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT response FROM llm_responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE llm_responses SET used = ? WHERE key = ?", (time.time(), key))
+            db.commit()
+            return row[0]
+        except sqlite3.Error as e:
+            print(f"[LLMResponseCache] sqlite read error: {e}")
+            return None
+
+    def _db_set(self, key: str, model: str, text: str) -> None:
+        with self._db_lock:
+            self._db_set_locked(key, model, text)
+
+    def _db_set_locked(self, key: str, model: str, text: str) -> None:
+        db = self._connection()
+        if db is None:
+            return
+        try:
+            now = time.time()
+            db.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, model, response, created, used) VALUES (?, ?, ?, ?, ?)",
+                (key, model, text, now, now),
+            )
+            self._writes += 1
+            if self._writes % PRUNE_EVERY == 0:
+                # оставляем LLM_CACHE_SQLITE_MAX_ROWS самых недавно использованных ответов
+                db.execute(
+                    "DELETE FROM llm_responses WHERE key NOT IN "
+                    "(SELECT key FROM llm_responses ORDER BY used DESC LIMIT ?)",
+                    (get_llm_cache_sqlite_max_rows(),),
+                )
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"[LLMResponseCache] sqlite write error: {e}")
+
+
+llm_cache = LLMResponseCache()
@@ -0,0 +1,267 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.config import (get_hf_token, get_llm_model_entry, get_local_model_pool_bytes, get_local_batch_size,
+                         get_local_batch_wait, get_local_torch_threads)
+from utils.json_stream import JsonObjectScanner, cut_after_json
+
+
+DEFAULT_CONTEXT_WINDOW = 1024
+# запас на то, что текст после обрезки токенизируется чуть иначе, чем кусок исходной последовательности
+TRUNCATION_MARGIN_TOKENS = 8
+
+
+def _json_stopping_criteria(tokenizer, prompt_length: int):
+    """
+    Критерий остановки generate: строка батча завершена, когда в её продолжении
+    закрылся валидный JSON-объект; generate останавливается, когда завершены все строки.
+    У каждой строки свой инкрементальный JsonObjectScanner, в который подаётся только
+    новый текст. Как в transformers.TextStreamer, декодируются лишь токены после последней
+    границы слова, поэтому шаг стоит O(длина слова), а не O(длина продолжения).
+    """
+    import torch
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class JsonStoppingCriteria(StoppingCriteria):
+        def __init__(self):
+            self.finished: Optional[torch.Tensor] = None
+            self.scanners: List[JsonObjectScanner] = []
+            # по строкам: с какого токена декодируется текущее слово и сколько его символов уже подано
+            self.word_start: List[int] = []
+            self.fed: List[int] = []
+
+        def __call__(self, input_ids, scores, **kwargs):
+            rows = input_ids.shape[0]
+            if self.finished is None:
+                self.finished = torch.zeros(rows, dtype=torch.bool, device=input_ids.device)
+                self.scanners = [JsonObjectScanner() for _ in range(rows)]
+                self.word_start = [prompt_length] * rows
+                self.fed = [0] * rows
+            for row in range(rows):
+                if self.finished[row]:
+                    continue
+                text = tokenizer.decode(input_ids[row, self.word_start[row]:], skip_special_tokens=True)
+                if text.endswith("\ufffd"):
+                    # последний токен — неполная UTF-8 последовательность, ждём следующий
+                    continue
+                self.finished[row] = self.scanners[row].feed(text[self.fed[row]:])
+                if text.endswith((" ", "\n")):
+                    self.word_start[row], self.fed[row] = input_ids.shape[1], 0
+                else:
+                    self.fed[row] = len(text)
+            return self.finished.clone()
+
+    return StoppingCriteriaList([JsonStoppingCriteria()])
+
+
+class LocalModel:
+    def __init__(self, name: str, model, tokenizer, size_bytes: int, context_window: int):
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.size_bytes = size_bytes
+        self.context_window = context_window
+
+
+class LocalModelPool:
+    """
+    Загруженные в память процесса модели transformers (CPU).
+    Суммарный размер весов ограничен LOCAL_MODEL_POOL_MB: при загрузке новой модели
+    вытесняются давно не использовавшиеся (LRU). Загрузка и вытеснение потокобезопасны;
+    модель загружается вне общей блокировки, поэтому загрузка одной модели не задерживает
+    запросы к уже загруженным, а одновременные запросы к загружаемой ждут одну загрузку.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes: int = get_local_model_pool_bytes() if max_bytes is None else max_bytes
+        self._models: "OrderedDict[str, LocalModel]" = OrderedDict()
+        self._loading: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._models)
+
+    def get(self, name: str) -> LocalModel:
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._models.move_to_end(name)
+                return entry
+            loading = self._loading.get(name)
+            if loading is None:
+                loading = self._loading[name] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return loading.result()
+
+        try:
+            entry = self._load(name)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(name, None)
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            self._models[name] = entry
+            self._loading.pop(name, None)
+            self._evict(keep=name)
+        loading.set_result(entry)
+        return entry
+
+    def _load(self, name: str) -> LocalModel:
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        threads = get_local_torch_threads()
+        if threads:
+            torch.set_num_threads(threads)
+
+        tokenizer = AutoTokenizer.from_pretrained(name, token=get_hf_token())
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+        model = AutoModelForCausalLM.from_pretrained(name, token=get_hf_token(), torch_dtype=torch.float32)
+        model.eval()
+
+        size_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+        context_window = (get_llm_model_entry(name) or {}).get(
+            'context_window', getattr(model.config, "max_position_embeddings", DEFAULT_CONTEXT_WINDOW)
+        )
+        print(f"[LocalModelPool] loaded {name} ({size_bytes / 1024 / 1024:.0f} MB)")
+        return LocalModel(name, model, tokenizer, size_bytes, context_window)
+
+    def _evict(self, keep: str) -> None:
+        total = sum(m.size_bytes for m in self._models.values())
+        for name in list(self._models):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            total -= self._models.pop(name).size_bytes
+            print(f"[LocalModelPool] evicted {name}")
+
+
+class LocalInferenceBackend:
+    """
+    Локальная генерация для моделей с 'backend': 'local' в llm_models_list.
+    Одновременные запросы к одной модели собираются в батч (до LOCAL_BATCH_SIZE,
+    ожидание не дольше LOCAL_BATCH_WAIT_MS) и генерируются одним вызовом generate
+    в отдельном потоке, не блокируя event loop.
+    """
+
+    def __init__(self, pool: Optional[LocalModelPool] = None):
+        self.pool = pool or LocalModelPool()
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+
+    async def chat(self, model: str, messages: List[Dict[str, str]], max_tokens: int,
+                   temperature: float, top_p: Optional[float] = None, stop_on_json: bool = False) -> str:
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = asyncio.Queue()
+            self._workers[model] = asyncio.create_task(self._worker(model, queue))
+        future = asyncio.get_running_loop().create_future()
+        await queue.put((messages, (max_tokens, temperature, top_p, stop_on_json), future))
+        return await future
+
+    async def close(self) -> None:
+        for task in self._workers.values():
+            task.cancel()
+        self._workers.clear()
+        self._queues.clear()
+
+    async def _worker(self, model: str, queue: asyncio.Queue) -> None:
+        while True:
+            batch = [await queue.get()]
+            deadline = asyncio.get_running_loop().time() + get_local_batch_wait()
+            while len(batch) < get_local_batch_size():
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # в один generate попадают только запросы с одинаковыми параметрами генерации
+            groups: Dict[Tuple, List[Tuple[List[Dict[str, str]], asyncio.Future]]] = {}
+            for messages, params, future in batch:
+                groups.setdefault(params, []).append((messages, future))
+            for params, items in groups.items():
+                try:
+                    texts = await asyncio.to_thread(self._generate, model, [m for m, _ in items], *params)
+                    for (_, future), text in zip(items, texts):
+                        if not future.done():
+                            future.set_result(text)
+                except Exception as e:
+                    for _, future in items:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def _generate(self, model_name: str, batch_messages: List[List[Dict[str, str]]], max_tokens: int,
+                  temperature: float, top_p: Optional[float], stop_on_json: bool = False) -> List[str]:
+        import torch
+
+        local = self.pool.get(model_name)
+        max_new_tokens = min(max_tokens, local.context_window // 2)
+        max_length = local.context_window - max_new_tokens
+        prompts = [self._fit_prompt(local.tokenizer, messages, max_length) for messages in batch_messages]
+
+        # truncation здесь — только страховка: длину промпта уже подогнал _fit_prompt
+        inputs = local.tokenizer(prompts, return_tensors="pt", padding=True, truncation=True,
+                                 max_length=max_length)
+        generate_kwargs: Dict[str, Any] = {
+            "max_new_tokens": max_new_tokens,
+            "pad_token_id": local.tokenizer.pad_token_id,
+            "do_sample": temperature > 0,
+        }
+        if temperature > 0:
+            generate_kwargs["temperature"] = temperature
+            if top_p is not None:
+                generate_kwargs["top_p"] = top_p
+        prompt_length = inputs["input_ids"].shape[1]
+        if stop_on_json:
+            generate_kwargs["stopping_criteria"] = _json_stopping_criteria(local.tokenizer, prompt_length)
+
+        with torch.inference_mode():
+            output = local.model.generate(**inputs, **generate_kwargs)
+        texts = local.tokenizer.batch_decode(output[:, prompt_length:], skip_special_tokens=True)
+        if stop_on_json:
+            texts = [cut_after_json(text) for text in texts]
+        return [text.strip() for text in texts]
+
+    def _fit_prompt(self, tokenizer, messages: List[Dict[str, str]], max_length: int) -> str:
+        """
+        Промпт не длиннее max_length токенов. Если он не помещается, укорачивается конец
+        последнего сообщения пользователя — там текст слайдов, он идёт после инструкции, —
+        а инструкция и шаблон диалога (с приглашением ассистенту) сохраняются целиком.
+        """
+        prompt = self._render_prompt(tokenizer, messages)
+        excess = len(tokenizer(prompt)["input_ids"]) - max_length
+        user_turns = [i for i, m in enumerate(messages) if m.get("role") == "user"]
+        if excess <= 0 or not user_turns:
+            return prompt
+
+        idx = user_turns[-1]
+        content_ids = tokenizer(messages[idx]["content"], add_special_tokens=False)["input_ids"]
+        keep = max(0, len(content_ids) - excess - TRUNCATION_MARGIN_TOKENS)
+        messages = list(messages)
+        messages[idx] = {**messages[idx], "content": tokenizer.decode(content_ids[:keep])}
+        return self._render_prompt(tokenizer, messages)
+
+    def _render_prompt(self, tokenizer, messages: List[Dict[str, str]]) -> str:
+        if getattr(tokenizer, "chat_template", None):
+            return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        # у базовых моделей (distilgpt2) шаблона диалога нет — склеиваем сообщения как текст
+        lines = [f"{m['role']}: {m['content']}" for m in messages]
+        return "\n\n".join(lines) + "\n\nassistant:"
+
+
+local_backend = LocalInferenceBackend()
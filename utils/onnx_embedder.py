@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+from typing import List, Optional, Union
+
+import numpy as np
+
+from core.config import get_hf_token
+
+MAX_SEQ_LENGTH = 256  # как у all-MiniLM-L6-v2 в sentence-transformers
+ONNX_OPSET = 14
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+# результат сверки с torch хранится рядом с моделью и сбрасывается при новом экспорте
+VERIFY_FILE = "verify.json"
+
+_export_lock = threading.Lock()
+
+
+def default_threads() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def export_quantized(model_name: str, directory: str) -> str:
+    """
+    Экспортирует трансформер модели в ONNX и квантует веса в int8 (динамическая квантизация).
+    Результат кешируется в directory; файлы пишутся через временное имя, поэтому
+    параллельные процессы не увидят недописанную модель.
+    """
+    int8_path = os.path.join(directory, "model.int8.onnx")
+    with _export_lock:
+        if os.path.exists(int8_path):
+            return int8_path
+
+        import torch
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        from transformers import AutoModel, AutoTokenizer
+
+        os.makedirs(directory, exist_ok=True)
+        fp32_path = os.path.join(directory, f"model.fp32.{os.getpid()}.onnx")
+        tmp_path = os.path.join(directory, f"model.int8.{os.getpid()}.onnx")
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(model_name, token=get_hf_token())
+            model = AutoModel.from_pretrained(model_name, token=get_hf_token()).eval()
+            dummy = tokenizer(["пример текста"], return_tensors="pt")
+            axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES + ["last_hidden_state"]}
+            with torch.inference_mode():
+                torch.onnx.export(
+                    model, tuple(dummy[name] for name in INPUT_NAMES), fp32_path,
+                    input_names=INPUT_NAMES, output_names=["last_hidden_state", "pooler_output"],
+                    dynamic_axes=axes, opset_version=ONNX_OPSET
+                )
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+            # сверка относилась к прежней модели
+            _remove(os.path.join(directory, VERIFY_FILE))
+            os.replace(tmp_path, int8_path)
+        finally:
+            _remove(fp32_path)
+            _remove(tmp_path)
+        print(f"[OnnxEmbedder] exported {model_name} to {int8_path}")
+        return int8_path
+
+
+def load_agreement(directory: str) -> Optional[float]:
+    """Сохранённый результат сверки с torch или None, если модель ещё не сверялась."""
+    try:
+        with open(os.path.join(directory, VERIFY_FILE), encoding="utf-8") as f:
+            return float(json.load(f)["agreement"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_agreement(directory: str, agreement: float) -> None:
+    path = os.path.join(directory, VERIFY_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"agreement": agreement}, f)
+    os.replace(tmp_path, path)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class OnnxEmbedder:
+    """
+    Эмбеддинги all-MiniLM-L6-v2 через onnxruntime с int8-весами: mean pooling по
+    attention_mask и L2-нормировка, как в sentence-transformers.
+    Динамический батчинг: тексты сортируются по длине в токенах и собираются в батчи
+    не больше max_batch_tokens (длина самого длинного × число текстов), поэтому
+    короткие тексты не дополняются до длины длинных.
+    Интерфейс encode совпадает с SentenceTransformer.encode в той части, что использует embedding.py.
+    """
+
+    def __init__(self, model_name: str, directory: str, threads: int = 0, max_batch_tokens: int = 8192):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, token=get_hf_token())
+        self.max_batch_tokens = max_batch_tokens
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or default_threads()
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(export_quantized(model_name, directory), options,
+                                            providers=["CPUExecutionProvider"])
+        self._inputs = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, texts: Union[str, List[str]], batch_size: int = 32,
+               normalize_embeddings: bool = True) -> np.ndarray:
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        lengths = [len(ids) for ids in self.tokenizer(texts, truncation=True, max_length=MAX_SEQ_LENGTH)["input_ids"]]
+        order = sorted(range(len(texts)), key=lengths.__getitem__)
+        outputs: List[Optional[np.ndarray]] = [None] * len(texts)
+        for batch in self._batches(order, lengths, batch_size):
+            vectors = self._embed([texts[i] for i in batch], normalize_embeddings)
+            for i, vec in zip(batch, vectors):
+                outputs[i] = vec
+        result = np.stack(outputs)
+        return result[0] if single else result
+
+    def _batches(self, order: List[int], lengths: List[int], batch_size: int) -> List[List[int]]:
+        # order отсортирован по возрастанию длины: последний текст батча — самый длинный
+        batches: List[List[int]] = []
+        current: List[int] = []
+        for i in order:
+            if current and (len(current) >= batch_size or lengths[i] * (len(current) + 1) > self.max_batch_tokens):
+                batches.append(current)
+                current = []
+            current.append(i)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed(self, texts: List[str], normalize: bool) -> np.ndarray:
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors="np")
+        feeds = {name: encoded[name].astype(np.int64) for name in INPUT_NAMES if name in self._inputs and name in encoded}
+        if "token_type_ids" in self._inputs and "token_type_ids" not in feeds:
+            feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+        hidden = self.session.run(["last_hidden_state"], feeds)[0]
+
+        mask = encoded["attention_mask"][..., None].astype(np.float32)
+        vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if normalize:
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.astype(np.float32)
+
+
+def cosine_agreement(a: np.ndarray, b: np.ndarray) -> float:
+    """Минимальная косинусная близость между соответствующими строками двух матриц эмбеддингов."""
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return float(np.min(np.sum(a * b, axis=1)))
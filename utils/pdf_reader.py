@@ -1,53 +1,569 @@
+import asyncio
+import hashlib
+import io
+import mmap
+import multiprocessing
 import tempfile
-from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Iterator, AsyncIterator, Tuple
 
 import pymupdf
-from pdf2image import convert_from_path
+from PIL import Image
 import os
 
-# POPPLER_PATH = r"D:\poppler\Library\bin"
+from core.config import (get_max_upload_size, get_upload_chunk_size, get_pdf_open_mmap,
+                         get_render_dpi, get_render_max_dimension, get_render_window_size,
+                         get_pdf_workers, get_pdf_parallel_min_pages, get_cache_page_images)
+
+from utils.result_cache import artifact_cache, make_key
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+# сколько байт тела multipart-запроса может приходиться на заголовки частей и границы
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class PdfTooLargeError(ValueError):
+    """Загруженный файл превышает допустимый размер."""
+
+
+class UploadFormatError(ValueError):
+    """Тело запроса не multipart/form-data, в нём нет файла или файл не PDF."""
+
+
+@dataclass
+class IngestedPdf:
+    path: str
+    sha256: str
+    size: int
+    filename: str = ""
+
+
+def ingest_upload(upload_file, max_size: Optional[int] = None, chunk_size: Optional[int] = None) -> IngestedPdf:
+    """
+    Потоково сохраняет загруженный файл во временный PDF.
+    Файл читается чанками, хеш SHA-256 считается по ходу записи,
+    поэтому в памяти никогда не находится больше одного чанка.
+    Если размер превышает max_size — запись прерывается, временный файл удаляется.
+    """
+    max_size = get_max_upload_size() if max_size is None else max_size
+    chunk_size = chunk_size or get_upload_chunk_size()
+
+    # к этому моменту Starlette уже принял всё тело запроса в свой временный файл — отсюда и size;
+    # проверка лишь избавляет от второй копии. Эндпоинты анализа используют ingest_request
+    declared_size = getattr(upload_file, 'size', None)
+    if max_size and declared_size and declared_size > max_size:
+        raise PdfTooLargeError(f"File is too large: {declared_size} bytes (limit {max_size})")
+
+    digest = hashlib.sha256()
+    size = 0
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+    try:
+        with tmp:
+            while True:
+                chunk = upload_file.file.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise PdfTooLargeError(f"File is too large: more than {max_size} bytes")
+                digest.update(chunk)
+                tmp.write(chunk)
+    except BaseException:
+        remove_temp_pdf(tmp.name)
+        raise
+
+    return IngestedPdf(path=tmp.name, sha256=digest.hexdigest(), size=size)
+
+def _multipart():
+    try:
+        from python_multipart import multipart
+    except ImportError:  # python-multipart < 0.0.13
+        from multipart import multipart
+    return multipart
+
+
+class _UploadPart:
+    """Состояние разбора multipart: данные нужного поля копятся в buffer до сброса на диск."""
+
+    def __init__(self, field_name: str):
+        self.field_name = field_name
+        self.filename: Optional[str] = None
+        self.found = False
+        self.active = False
+        self.buffer = bytearray()
+        self._headers: Dict[bytes, bytes] = {}
+        self._field = b""
+        self._value = b""
+
+    def callbacks(self) -> Dict[str, object]:
+        return {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        }
+
+    def _on_part_begin(self) -> None:
+        self._headers, self._field, self._value = {}, b"", b""
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._field.lower()] = self._value
+        self._field, self._value = b"", b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = _multipart().parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        if name != self.field_name or b"filename" not in options or self.found:
+            return
+        self.filename = options[b"filename"].decode("utf-8", "replace")
+        # не PDF — прерываем приём сразу, не дочитывая файл
+        if not self.filename.lower().endswith(".pdf"):
+            raise UploadFormatError("Only PDF files are supported")
+        self.active = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self.active:
+            self.buffer += data[start:end]
+
+    def _on_part_end(self) -> None:
+        if self.active:
+            self.active, self.found = False, True
+
+
+def _write_chunk(tmp, digest, data: bytes) -> None:
+    digest.update(data)
+    tmp.write(data)
+
+
+async def ingest_request(request, field_name: str = "file", max_size: Optional[int] = None,
+                         chunk_size: Optional[int] = None) -> IngestedPdf:
+    """
+    Принимает PDF прямо из потока тела multipart-запроса (request.stream()), без разбора
+    формы Starlette: файл копируется на диск один раз, хеш SHA-256 считается по ходу записи.
+    Запрос с Content-Length больше лимита отклоняется до чтения тела, без Content-Length —
+    как только принятые байты файла превысят лимит. Запись на диск и хеширование идут
+    в потоке частями по chunk_size, не блокируя event loop.
+    """
+    multipart = _multipart()
+    max_size = get_max_upload_size() if max_size is None else max_size
+    chunk_size = chunk_size or get_upload_chunk_size()
+
+    declared = request.headers.get("content-length", "")
+    if max_size and declared.isdigit() and int(declared) > max_size + MULTIPART_OVERHEAD:
+        raise PdfTooLargeError(f"File is too large: {declared} bytes (limit {max_size})")
+
+    content_type, options = multipart.parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise UploadFormatError("Expected multipart/form-data with a PDF file")
+
+    part = _UploadPart(field_name)
+    parser = multipart.MultipartParser(options[b"boundary"], part.callbacks())
+    digest = hashlib.sha256()
+    size = 0
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
+
+    async def flush() -> None:
+        nonlocal size
+        data = bytes(part.buffer)
+        part.buffer.clear()
+        size += len(data)
+        if max_size and size > max_size:
+            raise PdfTooLargeError(f"File is too large: more than {max_size} bytes")
+        await asyncio.to_thread(_write_chunk, tmp, digest, data)
+
+    try:
+        with tmp:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if len(part.buffer) >= chunk_size:
+                    await flush()
+            parser.finalize()
+            if part.buffer:
+                await flush()
+        if not part.found:
+            raise UploadFormatError(f"No file in form field '{field_name}'")
+    except BaseException:
+        remove_temp_pdf(tmp.name)
+        raise
+
+    return IngestedPdf(path=tmp.name, sha256=digest.hexdigest(), size=size, filename=part.filename or "")
 
 def save_temp_pdf(upload_file):
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp:
-        tmp.write(upload_file.file.read())
-        return tmp.name
+    return ingest_upload(upload_file).path
+
+def remove_temp_pdf(pdf_path: Optional[str]) -> None:
+    if not pdf_path:
+        return
+    try:
+        os.unlink(pdf_path)
+    except FileNotFoundError:
+        pass
+
+def open_pdf(pdf_path: str, use_mmap: Optional[bool] = None):
+    """
+    Открывает PDF через pymupdf.
+    При use_mmap файл отображается в память и передаётся pymupdf как memoryview,
+    без промежуточного чтения в bytes. Сам mmap передавать нельзя: у него есть read(),
+    и pymupdf молча скопировал бы через него весь файл. Если сборка pymupdf
+    не принимает memoryview — открываем по пути (MuPDF читает файл сам).
+    """
+    if use_mmap is None:
+        use_mmap = get_pdf_open_mmap()
+    if not use_mmap or os.path.getsize(pdf_path) == 0:
+        return pymupdf.open(pdf_path)
+
+    with open(pdf_path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buffer)
+    try:
+        # документ держит ссылку на view (а через неё на mmap), они освобождаются вместе с ним
+        return pymupdf.open(stream=view, filetype='pdf')
+    except TypeError as e:
+        print(f"[pdf_reader] pymupdf does not accept memoryview ({e}), opening {pdf_path} by path")
+        view.release()
+        buffer.close()
+        return pymupdf.open(pdf_path)
+
+def _render_page(page, dpi: int, max_dimension: Optional[int]) -> Image.Image:
+    """
+    Растеризует страницу pymupdf в RGB-изображение PIL.
+    Масштаб берётся из dpi и, при необходимости, уменьшается так,
+    чтобы длинная сторона не превышала max_dimension.
+    """
+    zoom = dpi / 72.0
+    if max_dimension:
+        longest = max(page.rect.width, page.rect.height) * zoom
+        if longest > max_dimension:
+            zoom *= max_dimension / longest
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csRGB, alpha=False)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv)
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Общий пул процессов для разбора PDF, создаётся при первом обращении."""
+    global _process_pool
+    if _process_pool is None:
+        # spawn: форк процесса с потоками uvicorn/torch небезопасен
+        _process_pool = ProcessPoolExecutor(max_workers=get_pdf_workers(),
+                                            mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+def shutdown_process_pool() -> None:
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+def _split_range(start: int, stop: int, parts: int) -> List[Tuple[int, int]]:
+    """Делит [start, stop) на не более чем parts непрерывных диапазонов почти равной длины."""
+    total = stop - start
+    parts = max(1, min(parts, total))
+    step, extra = divmod(total, parts)
+    ranges = []
+    for i in range(parts):
+        end = start + step + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+def _contiguous_runs(page_nums: List[int]) -> List[Tuple[int, int]]:
+    """Разбивает возрастающий список номеров страниц на непрерывные диапазоны [start, stop)."""
+    runs = []
+    for page_num in page_nums:
+        if runs and runs[-1][1] == page_num:
+            runs[-1] = (runs[-1][0], page_num + 1)
+        else:
+            runs.append((page_num, page_num + 1))
+    return runs
+
+def _extract_text_range_from_doc(doc, start: int, stop: int) -> List[Dict]:
+    slides_text = []
+    for page_num in range(start, stop):
+        text = doc[page_num].get_text()
+        slides_text.append({
+            'slide_number' : page_num + 1,
+            'text' : text,
+            'word_count' : len(text.split())
+        })
+    return slides_text
+
+def _extract_text_range(pdf_path: str, start: int, stop: int) -> List[Dict]:
+    """Воркер пула: каждый процесс открывает свой экземпляр документа."""
+    with pymupdf.open(pdf_path) as doc:
+        return _extract_text_range_from_doc(doc, start, stop)
+
+def _render_range(pdf_path: str, start: int, stop: int, dpi: int,
+                  max_dimension: Optional[int]) -> List[Tuple[Tuple[int, int], bytes]]:
+    """Воркер пула: возвращает сырые RGB-буферы, изображения собираются в родительском процессе."""
+    rendered = []
+    with pymupdf.open(pdf_path) as doc:
+        for page_num in range(start, stop):
+            img = _render_page(doc[page_num], dpi, max_dimension)
+            rendered.append((img.size, img.tobytes()))
+            img.close()
+    return rendered
+
+
+async def _settle(task: asyncio.Future) -> None:
+    """
+    Дожидается завершения задачи, даже если ожидающего отменяют; ошибки задачи подавляются,
+    а отмена ожидающего пробрасывается после её завершения.
+    """
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            cancelled = True
+    if not task.cancelled():
+        task.exception()
+    if cancelled:
+        raise asyncio.CancelledError()
+
+
+class PdfDocument:
+    """
+    PDF, открытый один раз: из одного pymupdf-документа берутся
+    текст по слайдам, количество слов и растровые изображения страниц.
+    """
+
+    def __init__(self, pdf_path: str, dpi: Optional[int] = None, max_dimension: Optional[int] = None,
+                 use_mmap: Optional[bool] = None, sha256: Optional[str] = None):
+        self.path = pdf_path
+        self.dpi: int = dpi or get_render_dpi()
+        self.max_dimension: Optional[int] = get_render_max_dimension() if max_dimension is None else max_dimension
+        # при известном хеше текст и изображения слайдов берутся из artifact_cache,
+        # и сам PDF открывается только если чего-то в кеше не нашлось
+        self.sha256: Optional[str] = sha256
+        self._use_mmap = use_mmap
+        self._doc = None
+        self._slides_text: Optional[List[Dict]] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            self._doc = open_pdf(self.path, self._use_mmap)
+        return self._doc
+
+    def close(self) -> None:
+        if self._doc is not None and not self._doc.is_closed:
+            self._doc.close()
+
+    @property
+    def page_count(self) -> int:
+        if self._slides_text is None and self.sha256:
+            self._slides_text = artifact_cache.get(self._artifact_key('slides_text'))
+        if self._slides_text is not None:
+            return len(self._slides_text)
+        return self.doc.page_count
+
+    @property
+    def parallel(self) -> bool:
+        """Большие документы разбираются в пуле процессов, маленькие — последовательно."""
+        return get_pdf_workers() > 1 and self.page_count >= get_pdf_parallel_min_pages()
+
+    def _artifact_key(self, kind: str, *params) -> str:
+        return make_key(self.sha256, kind, *params)
+
+    def slides_text(self) -> List[Dict]:
+        """Текст и количество слов по каждому слайду (кешируется на время жизни документа)."""
+        if self._slides_text is None and self.sha256:
+            self._slides_text = artifact_cache.get(self._artifact_key('slides_text'))
+        if self._slides_text is None:
+            if self.parallel:
+                self._slides_text = self._slides_text_parallel()
+            else:
+                self._slides_text = _extract_text_range_from_doc(self.doc, 0, self.page_count)
+            if self.sha256:
+                artifact_cache.set(self._artifact_key('slides_text'), self._slides_text)
+        return self._slides_text
+
+    def _slides_text_parallel(self) -> List[Dict]:
+        ranges = _split_range(0, self.page_count, get_pdf_workers())
+        pool = get_process_pool()
+        futures = [pool.submit(_extract_text_range, self.path, start, stop) for start, stop in ranges]
+        # результаты собираются в порядке диапазонов, то есть в порядке слайдов
+        slides_text = []
+        for future in futures:
+            slides_text.extend(future.result())
+        return slides_text
+
+    def full_text(self) -> str:
+        return "".join(slide['text'] for slide in self.slides_text())
+
+    def render_page(self, page_num: int) -> Image.Image:
+        """page_num — индекс страницы с нуля."""
+        return _render_page(self.doc[page_num], self.dpi, self.max_dimension)
+
+    def images(self) -> List[Image.Image]:
+        return list(self.iter_images())
+
+    def iter_images(self, window_size: Optional[int] = None) -> Iterator[Image.Image]:
+        """
+        Ленивый генератор изображений слайдов: страницы растеризуются окнами
+        по window_size, и следующее окно рендерится только когда предыдущее
+        отдано потребителю, поэтому в памяти находятся лишь те изображения,
+        на которые у потребителя ещё есть ссылки.
+        В параллельном режиме окно рендерится в пуле процессов.
+        Блокирующий: в обработчиках FastAPI используется aiter_images.
+        """
+        for page_nums in self._windows(self.page_count, window_size):
+            yield from self._window_images(page_nums)
+
+    async def aiter_images(self, window_size: Optional[int] = None) -> AsyncIterator[Image.Image]:
+        """
+        Асинхронный вариант iter_images: рендеринг, чтение кеша и сборка изображений идут
+        вне цикла событий (в пуле процессов или в потоке). Следующее окно рендерится,
+        пока потребитель обрабатывает текущее, поэтому в памяти не больше двух окон.
+        """
+        counting = asyncio.ensure_future(asyncio.to_thread(lambda: (self.page_count, self.parallel)))
+        try:
+            page_count, parallel = await asyncio.shield(counting)
+        except asyncio.CancelledError:
+            await _settle(counting)
+            raise
+        windows = self._windows(page_count, window_size)
+        upcoming = asyncio.ensure_future(self._awindow_images(windows[0], parallel)) if windows else None
+        try:
+            for i in range(len(windows)):
+                images = await upcoming
+                upcoming = None
+                if i + 1 < len(windows):
+                    upcoming = asyncio.ensure_future(self._awindow_images(windows[i + 1], parallel))
+                for img in images:
+                    yield img
+        finally:
+            if upcoming is not None:
+                # потребитель остановился раньше. В пуле процессов ещё не начатые диапазоны
+                # снимаются; последовательное окно рендерится в потоке из self.doc, и отмена задачи
+                # поток не останавливает — дожидаемся его, иначе документ закроют у него из-под рук
+                if parallel:
+                    upcoming.cancel()
+                await _settle(upcoming)
+
+    def _windows(self, page_count: int, window_size: Optional[int]) -> List[range]:
+        window_size = window_size or get_render_window_size()
+        return [range(start, min(start + window_size, page_count)) for start in range(0, page_count, window_size)]
+
+    def _window_images(self, page_nums: range) -> List[Image.Image]:
+        images = {page_num: self._cached_image(page_num) for page_num in page_nums}
+        missing = [page_num for page_num in page_nums if images[page_num] is None]
+        for page_num, img in self._render_pages(missing):
+            self._store_image(page_num, img)
+            images[page_num] = img
+        return [images[page_num] for page_num in page_nums]
+
+    async def _awindow_images(self, page_nums: range, parallel: bool) -> List[Image.Image]:
+        if not parallel:
+            return await asyncio.to_thread(self._window_images, page_nums)
+
+        images = await asyncio.to_thread(lambda: {page_num: self._cached_image(page_num) for page_num in page_nums})
+        missing = [page_num for page_num in page_nums if images[page_num] is None]
+        ranges = self._render_ranges(missing)
+        loop = asyncio.get_running_loop()
+        pool = get_process_pool()
+        # все диапазоны окна отправляются в пул сразу и рендерятся на всех воркерах одновременно
+        rendered = await asyncio.gather(*(
+            loop.run_in_executor(pool, _render_range, self.path, start, stop, self.dpi, self.max_dimension)
+            for start, stop in ranges
+        ))
+
+        def assemble() -> None:
+            for (start, _), pages in zip(ranges, rendered):
+                for offset, (size, samples) in enumerate(pages):
+                    img = Image.frombytes("RGB", size, samples)
+                    self._store_image(start + offset, img)
+                    images[start + offset] = img
+
+        await asyncio.to_thread(assemble)
+        return [images[page_num] for page_num in page_nums]
+
+    def _render_ranges(self, page_nums: List[int]) -> List[Tuple[int, int]]:
+        # непрерывные диапазоны страниц делятся между воркерами: каждый воркер
+        # открывает документ один раз на диапазон, а не на каждую страницу
+        workers = get_pdf_workers()
+        return [part for start, stop in _contiguous_runs(page_nums) for part in _split_range(start, stop, workers)]
+
+    def _render_pages(self, page_nums: List[int]) -> Iterator[Tuple[int, Image.Image]]:
+        if not page_nums:
+            return
+        if not self.parallel:
+            for page_num in page_nums:
+                yield page_num, self.render_page(page_num)
+            return
+
+        ranges = self._render_ranges(page_nums)
+        pool = get_process_pool()
+        futures = [pool.submit(_render_range, self.path, start, stop, self.dpi, self.max_dimension)
+                   for start, stop in ranges]
+        for (start, _), future in zip(ranges, futures):
+            for offset, (size, samples) in enumerate(future.result()):
+                yield start + offset, Image.frombytes("RGB", size, samples)
+
+    @property
+    def caches_images(self) -> bool:
+        """Изображения страниц кешируются только при CACHE_PAGE_IMAGES: PNG-кодирование недёшево."""
+        return bool(self.sha256) and artifact_cache.enabled and get_cache_page_images()
+
+    def _cached_image(self, page_num: int) -> Optional[Image.Image]:
+        if not self.caches_images:
+            return None
+        data = artifact_cache.get_bytes(self._artifact_key('page', page_num, self.dpi, self.max_dimension))
+        if data is None:
+            return None
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        return img.convert("RGB") if img.mode != "RGB" else img
+
+    def _store_image(self, page_num: int, img: Image.Image) -> None:
+        if not self.caches_images:
+            return
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", compress_level=1)
+        artifact_cache.set_bytes(self._artifact_key('page', page_num, self.dpi, self.max_dimension), buf.getvalue())
+
 
 def extract_text(pdf_path):
     text = ""
     try:
-        doc = pymupdf.open(pdf_path)
-        for page in doc:
-            text += page.get_text()
-        doc.close()
+        with PdfDocument(pdf_path) as doc:
+            text = doc.full_text()
     except Exception as e:
         print(f"Error extracting text: {e}")
     return text
 
-def pdf_to_images(pdf_path):
+def pdf_to_images(pdf_path, dpi: Optional[int] = None, max_dimension: Optional[int] = None):
     try:
-        # Указываем явный путь тулзы poppler, без docker-контейнера
-        # images = convert_from_path(pdf_path, poppler_path=POPPLER_PATH)
-
-        #При использовании docker-контейнера, тулза автоматически подключается.
-        images = convert_from_path(pdf_path)
-        return images
+        with PdfDocument(pdf_path, dpi=dpi, max_dimension=max_dimension) as doc:
+            return doc.images()
     except Exception as e:
         print(f"Error converting PDF to images: {e}")
         return []
 
-def extract_text_by_slides(pdf_path: str) -> List[Dict]:
+def extract_text_by_slides(pdf_path: str, sha256: Optional[str] = None) -> List[Dict]:
     slides_text = []
     try:
-        doc = pymupdf.open(pdf_path)
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            slides_text.append({
-                'slide_number' : page_num + 1,
-                'text' : text,
-                'word_count' : len(text.split())
-            })
-        doc.close()
+        with PdfDocument(pdf_path, sha256=sha256) as doc:
+            slides_text = doc.slides_text()
     except Exception as e:
         print(f'Error extracting text by slides : {e}')
     return slides_text
\ No newline at end of file
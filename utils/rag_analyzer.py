@@ -1,71 +1,205 @@
 
 
-from typing import List, Dict, Any
-from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, VectorParams, Distance
-from core.config import get_qdrant_url, get_qdrant_api_key
-from utils.embedding import embed_text
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+from core.config import (get_qdrant_url, get_qdrant_api_key, get_rag_embed_batch_size, get_rag_upsert_batch_size,
+                         get_rag_upsert_parallel, get_rag_query_cache_size, get_rag_query_cache_ttl, get_rag_backend,
+                         get_rag_local_dir, get_rag_local_ivf_lists, get_rag_local_ivf_nprobe)
+from utils.embedding import EMBEDDING_DIM, embed_text, embed_texts
+from utils.vector_store import LocalVectorStore, QdrantStore
+
+
+def normalize_query(text: str) -> str:
+    # all-MiniLM-L6-v2 не различает регистр, поэтому регистр и пробелы на эмбеддинг не влияют
+    return " ".join(text.split()).lower()
+
+
+class QueryCache:
+    """Потокобезопасный LRU на max_items записей; при ttl > 0 записи старше ttl секунд не возвращаются."""
+
+    def __init__(self, max_items: int, ttl: int = 0):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._items: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self.ttl and time.time() - item[0] > self.ttl:
+                del self._items[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.time(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "items": len(self._items),
+            }
 
 
 class RAGAnalyzer:
     """
-    RAG Analyzer с использованием Qdrant для семантического поиска по контексту.
+    RAG Analyzer для семантического поиска по контексту.
+    Хранилище выбирается RAG_BACKEND: Qdrant или локальный индекс (LocalVectorStore).
+    Эмбеддинги запросов и результаты поиска кешируются в памяти. Результаты привязаны
+    к версии коллекции, которая растёт при каждой записи (add_records), поэтому после
+    загрузки документов поиск выполняется заново; записи других процессов учитываются
+    не позже чем через RAG_QUERY_CACHE_TTL.
     """
 
     def __init__(self, collection_name: str = "presentation_rules"):
         self.collection_name = collection_name
-        self.client: QdrantClient | None = None
+        self.store: QdrantStore | LocalVectorStore | None = None
         self.initialized: bool = False
+        self._init_lock = threading.Lock()
+        self.version: int = 0
+        # upsert частей идёт из потоков пула — версия увеличивается под блокировкой
+        self._version_lock = threading.Lock()
+        self.embedding_cache = QueryCache(get_rag_query_cache_size())
+        self.result_cache = QueryCache(get_rag_query_cache_size(), ttl=get_rag_query_cache_ttl())
 
     def initialize(self):
-        api_url = get_qdrant_url()
-        api_token = get_qdrant_api_key()
+        # вызывается и фоновым прогревом, и первым запросом — подключаемся один раз
+        with self._init_lock:
+            if self.initialized:
+                return
 
-        if not api_url or not api_token:
-            raise ValueError("Не заданы QDRANT_API_URL или QDRANT_API_TOKEN")
+            if get_rag_backend() == "local":
+                self.store = LocalVectorStore(
+                    os.path.join(get_rag_local_dir(), self.collection_name), EMBEDDING_DIM,
+                    ivf_lists=get_rag_local_ivf_lists(), nprobe=get_rag_local_ivf_nprobe()
+                )
+            else:
+                api_url = get_qdrant_url()
+                api_token = get_qdrant_api_key()
 
-        self.client = QdrantClient(url=api_url, api_key=api_token)
+                if not api_url or not api_token:
+                    raise ValueError("Не заданы QDRANT_URL или QDRANT_API_KEY (или используйте RAG_BACKEND=local)")
 
-        if not self.client.collection_exists(self.collection_name):
-            vector_params = VectorParams(size=384, distance=Distance.COSINE)
-            self.client.create_collection(
-                collection_name=self.collection_name,
-                vectors_config=vector_params
-            )
+                self.store = QdrantStore(self.collection_name, EMBEDDING_DIM, api_url, api_token)
 
-        self.initialized = True
+            self.initialized = True
 
-    def add_documents(self, docs: List[str], ids: List[int] | None = None):
-        if not self.initialized or self.client is None:
-            raise RuntimeError("RAGAnalyzer не инициализирован")
+    def add_documents(self, docs: List[str], ids: List[int] | None = None) -> int:
+        if ids and len(ids) != len(docs):
+            raise ValueError(f"Количество ids ({len(ids)}) не совпадает с количеством документов ({len(docs)})")
+        return self.add_records(zip(docs, ids) if ids else ((doc, None) for doc in docs))
 
-        points: List[PointStruct] = []
-        for idx, doc in enumerate(docs):
-            vec = embed_text(doc)
-            point_id = ids[idx] if ids else None
-            points.append(PointStruct(id=point_id, vector=vec, payload={"text": doc}))
+    def add_records(self, records: Iterable[Tuple[str, Optional[int]]]) -> int:
+        """
+        Загрузка документов (text, id) из любого итерируемого источника, в т.ч. потокового.
+        Документы читаются частями по RAG_UPSERT_BATCH_SIZE, эмбеддинги считаются батчами
+        по RAG_EMBED_BATCH_SIZE, а upsert частей идёт в фоне (до RAG_UPSERT_PARALLEL одновременно),
+        пока считается следующая часть. В памяти — не больше нескольких частей.
+        Документы без id получают случайный UUID.
+        """
+        if not self.initialized or self.store is None:
+            raise RuntimeError("RAGAnalyzer не инициализирован")
 
-        self.client.upsert(collection_name=self.collection_name, points=points)
+        records = iter(records)
+        parallel = max(1, get_rag_upsert_parallel())
+        added = 0
+        pending = set()
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            try:
+                while True:
+                    chunk = list(islice(records, get_rag_upsert_batch_size()))
+                    if not chunk:
+                        break
+                    texts = [text for text, _ in chunk]
+                    ids = [point_id if point_id is not None else str(uuid.uuid4()) for _, point_id in chunk]
+                    vectors = embed_texts(texts, batch_size=get_rag_embed_batch_size())
+                    # ограничиваем число частей в полёте, иначе быстрый эмбеддинг накопит их в памяти
+                    if len(pending) >= parallel:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(executor.submit(self._upsert, ids, vectors, texts))
+                    added += len(chunk)
+                for future in pending:
+                    future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+        return added
+
+    def _upsert(self, ids: List[Any], vectors: List[List[float]], texts: List[str]) -> None:
+        try:
+            self.store.upsert(ids, vectors, texts)
+        finally:
+            self._invalidate()
+
+    def _invalidate(self) -> None:
+        # новые ключи содержат новую версию, старые результаты больше не нужны
+        with self._version_lock:
+            self.version += 1
+        self.result_cache.clear()
 
     def query(self, query_text: str, top_k: int = 3) -> List[Dict[str, Any]]:
         """
         Семантический поиск по коллекции.
         Возвращает top_k наиболее релевантных документов.
         """
-        if not self.initialized or not self.client:
+        if not self.initialized or not self.store:
             raise RuntimeError("RAGAnalyzer не инициализирован")
 
-        vec = embed_text(query_text)
-
-        search_result = self.client.query_points(
-            collection_name=self.collection_name,
-            query=vec,
-            limit=top_k
-        )
-
-        return [
-            {"text": point.payload.get("text", ""), "score": point.score}
-            for point in search_result.points
+        normalized = normalize_query(query_text)
+        query_hash = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        result_key = (query_hash, top_k, self.version)
+        cached = self.result_cache.get(result_key)
+        if cached is not None:
+            return [dict(item) for item in cached]
+
+        vec = self.embedding_cache.get(query_hash)
+        if vec is None:
+            vec = embed_text(normalized)
+            self.embedding_cache.set(query_hash, vec)
+
+        results = [
+            {"text": text, "score": score}
+            for text, score in self.store.search(vec, top_k)
         ]
+        # версия могла смениться, пока шёл поиск — тогда результат сохранится под старым ключом и не будет найден
+        self.result_cache.set(result_key, results)
+        return [dict(item) for item in results]
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {
+            "collection_version": self.version,
+            "embeddings": self.embedding_cache.stats(),
+            "results": self.result_cache.stats(),
+        }
 
 rag_analyzer = RAGAnalyzer()
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from core.config import (get_cache_enabled, get_cache_dir, get_cache_ttl, get_cache_max_disk_bytes,
+                         get_cache_memory_bytes, get_caption_cache_max_disk_bytes)
+
+
+def make_key(*parts, **params) -> str:
+    """
+    Ключ кеша: SHA-256 от позиционных частей (хеш PDF, эндпоинт, модель...)
+    и именованных параметров анализа.
+    """
+    payload = json.dumps([parts, params], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Двухуровневый кеш: LRU в памяти процесса + файловое хранилище на диске.
+    Память ограничена суммарным размером значений, диск — TTL и общим размером
+    (при переполнении удаляются самые давно использованные файлы).
+    JSON-значения хранятся сериализованными, поэтому get всегда возвращает
+    независимую копию, которую можно изменять.
+    """
+
+    def __init__(self, namespace: str, cache_dir: Optional[str] = None, ttl: Optional[int] = None,
+                 max_disk_bytes: Optional[int] = None, memory_bytes: Optional[int] = None,
+                 enabled: Optional[bool] = None):
+        self.enabled: bool = get_cache_enabled() if enabled is None else enabled
+        self.cache_dir: str = os.path.join(cache_dir or get_cache_dir(), namespace)
+        self.ttl: int = get_cache_ttl() if ttl is None else ttl
+        self.max_disk_bytes: int = get_cache_max_disk_bytes() if max_disk_bytes is None else max_disk_bytes
+        self.memory_bytes: int = get_cache_memory_bytes() if memory_bytes is None else memory_bytes
+
+        # ключ -> (время записи, данные); время нужно, чтобы TTL соблюдался и для записей в памяти
+        self._memory: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._memory_size: int = 0
+        self._disk_size: Optional[int] = None
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    # ---- публичный API ------------------------------------------------------
+    def get(self, key: str) -> Optional[Any]:
+        data = self.get_bytes(key)
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+
+    def set(self, key: str, value: Any) -> None:
+        self.set_bytes(key, json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                written, data = entry
+                if not self._expired(written):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return data
+                self._forget(key)
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is not None:
+                self._remember(key, entry[1], written=entry[0])
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry[1] if entry is not None else None
+
+    def set_bytes(self, key: str, data: bytes) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._remember(key, data)
+        try:
+            self._write_disk(key, data)
+        except OSError as e:
+            print(f"[ResultCache] disk write error: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "memory_items": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_bytes": self._disk_size,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        for path, _, _, _ in self._scan_disk():
+            self._remove(path)
+        self._disk_size = 0
+
+    # ---- память -------------------------------------------------------------
+    def _expired(self, written: float) -> bool:
+        return bool(self.ttl) and time.time() - written > self.ttl
+
+    def _remember(self, key: str, data: bytes, written: Optional[float] = None) -> None:
+        self._forget(key)
+        if len(data) > self.memory_bytes:
+            return
+        self._memory[key] = (time.time() if written is None else written, data)
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes and self._memory:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _forget(self, key: str) -> None:
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old[1])
+
+    # ---- диск ---------------------------------------------------------------
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, bytes]]:
+        """(время записи, данные) или None, если файла нет или он просрочен."""
+        path = self._path(key)
+        try:
+            mtime = os.path.getmtime(path)
+            if self._expired(mtime):
+                self._remove(path)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            # atime ненадёжен (noatime), поэтому «использование» отмечаем через utime
+            os.utime(path, (time.time(), mtime))
+            return mtime, data
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._disk_size is None:
+                self._disk_size = sum(entry[1] for entry in self._scan_disk())
+            else:
+                self._disk_size += len(data) - previous
+            overflow = self.max_disk_bytes and self._disk_size > self.max_disk_bytes
+        if overflow:
+            self._evict_disk()
+
+    def _scan_disk(self):
+        """(путь, размер, время последнего использования, время записи) для всех файлов пространства имён."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, st.st_size, st.st_atime, st.st_mtime))
+        return entries
+
+    def _evict_disk(self) -> None:
+        """Удаляет просроченные, затем самые давно использованные файлы до 90% лимита."""
+        now = time.time()
+        total = 0
+        alive = []
+        for path, size, used, written in self._scan_disk():
+            if self.ttl and now - written > self.ttl:
+                self._remove(path)
+                continue
+            alive.append((path, size, used))
+            total += size
+
+        target = int(self.max_disk_bytes * 0.9)
+        for path, size, _ in sorted(alive, key=lambda e: e[2]):
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+
+        with self._lock:
+            self._disk_size = total
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+result_cache = ResultCache("results")
+artifact_cache = ResultCache("artifacts")
+# конспекты частей презентации для анализа контента (ключ — хеш текста части)
+summary_cache = ResultCache("summaries")
+# подписи не устаревают (одно и то же изображение + модель), поэтому без TTL, только LRU по размеру
+caption_cache = ResultCache("captions", ttl=0, max_disk_bytes=get_caption_cache_max_disk_bytes())
@@ -0,0 +1,66 @@
+import hashlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from core.config import get_dedup_hamming_threshold
+
+
+HASH_SIZE = 8
+FINGERPRINT_SIZE = (256, 144)
+
+
+def dhash(img: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """
+    Разностный перцептивный хеш (dHash): слайд сжимается до (hash_size+1) x hash_size
+    в оттенках серого, каждый бит — «левый пиксель ярче правого».
+    Близкие по виду слайды дают хеши с малым расстоянием Хэмминга.
+    """
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def image_fingerprint(img: Image.Image) -> str:
+    """
+    Точный (не перцептивный) отпечаток слайда: SHA-256 от RGB-изображения,
+    приведённого к фиксированному размеру. Одинаковые слайды, отрендеренные
+    с одинаковыми настройками, дают одинаковый отпечаток.
+    """
+    normalized = img.convert("RGB").resize(FINGERPRINT_SIZE, Image.BILINEAR, reducing_gap=2.0)
+    return hashlib.sha256(normalized.tobytes()).hexdigest()
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class SlideDeduplicator:
+    """
+    Группирует почти одинаковые слайды (шаги анимации, повторяющиеся шаблонные слайды).
+    Слайды поступают по одному; каждый сравнивается с представителями уже найденных групп.
+    """
+
+    def __init__(self, threshold: Optional[int] = None):
+        self.threshold: int = get_dedup_hamming_threshold() if threshold is None else threshold
+        self._representatives: List[Tuple[int, int]] = []  # (хеш, номер слайда-представителя)
+
+    def assign(self, slide_number: int, img: Image.Image) -> Optional[int]:
+        """
+        Возвращает номер слайда-представителя, если слайд — почти дубликат уже виденного,
+        иначе регистрирует слайд как представителя новой группы и возвращает None.
+        """
+        if self.threshold < 0:
+            return None
+        h = dhash(img)
+        best = None
+        best_distance = self.threshold + 1
+        for rep_hash, rep_number in self._representatives:
+            distance = hamming_distance(h, rep_hash)
+            if distance < best_distance:
+                best, best_distance = rep_number, distance
+        if best is None:
+            self._representatives.append((h, slide_number))
+        return best
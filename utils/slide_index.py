@@ -0,0 +1,81 @@
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Tuple
+
+
+MIN_WORD_LEN = 3
+NGRAM_MIN = 3
+NGRAM_MAX = 6
+TOP_SLIDES = 3
+# в ответ по TF-IDF попадают слайды, набравшие не меньше этой доли от лучшего результата
+RELATIVE_SCORE_CUTOFF = 0.5
+
+
+def tokenize(text: str) -> List[str]:
+    """Значимые слова в нижнем регистре (короткие слова и пунктуация отбрасываются)."""
+    return [w for w in re.findall(r'\w+', text.lower()) if len(w) >= MIN_WORD_LEN]
+
+
+class SlideIndex:
+    """
+    Индекс текста слайдов одной презентации для привязки замечаний модели к номерам слайдов.
+    Строится один раз на отчёт:
+     - словарь n-грамм слов (NGRAM_MIN..NGRAM_MAX) -> слайды, где они встречаются;
+       поиск фразы — O(число n-грамм в ней) вместо сканирования всех слайдов подстрокой;
+     - инвертированный индекс слово -> {слайд: частота} с IDF для запасного ранжирования.
+    """
+
+    def __init__(self, slides: List[Dict[str, Any]]):
+        self.slide_numbers: List[int] = [s["num"] for s in slides]
+        self._ngrams: Dict[Tuple[str, ...], List[int]] = defaultdict(list)
+        self._postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+
+        for slide in slides:
+            words = tokenize(slide["text"])
+            for word, tf in Counter(words).items():
+                self._postings[word][slide["num"]] = tf
+            seen = set()
+            for n in range(NGRAM_MIN, NGRAM_MAX + 1):
+                for i in range(len(words) - n + 1):
+                    gram = tuple(words[i:i + n])
+                    if gram not in seen:
+                        seen.add(gram)
+                        self._ngrams[gram].append(slide["num"])
+
+        total = len(self.slide_numbers)
+        self._idf: Dict[str, float] = {
+            word: math.log((total + 1) / (len(posting) + 1)) + 1.0
+            for word, posting in self._postings.items()
+        }
+
+    def match(self, text: str) -> List[int]:
+        """
+        Номера слайдов, к которым относится text (может быть пуст):
+         - по самым длинным общим n-граммам: побеждает слайд, где их больше всего;
+         - если общих n-грамм нет — до TOP_SLIDES слайдов с наибольшим TF-IDF весом общих слов.
+        """
+        words = tokenize(text)
+        if not words:
+            return []
+
+        for n in range(min(NGRAM_MAX, len(words)), NGRAM_MIN - 1, -1):
+            votes: Counter = Counter()
+            for i in range(len(words) - n + 1):
+                for num in self._ngrams.get(tuple(words[i:i + n]), ()):
+                    votes[num] += 1
+            if votes:
+                return [min(votes, key=lambda num: (-votes[num], num))]
+
+        scores: Counter = Counter()
+        for word in set(words):
+            idf = self._idf.get(word)
+            if idf is None:
+                continue
+            for num, tf in self._postings[word].items():
+                scores[num] += (1.0 + math.log(tf)) * idf
+        if not scores:
+            return []
+        ranked = sorted(scores, key=lambda num: (-scores[num], num))[:TOP_SLIDES]
+        best = scores[ranked[0]]
+        return [num for num in ranked if scores[num] >= best * RELATIVE_SCORE_CUTOFF]
@@ -0,0 +1,100 @@
+import threading
+from typing import Any, Dict, List, Optional
+
+from core.config import get_hf_token, get_llm_model_entry, get_llm_prompt_token_budget, get_llm_use_tokenizer
+
+
+DEFAULT_CONTEXT_WINDOW = 4096
+MIN_PROMPT_BUDGET = 256
+# Для оценки без токенизатора: кириллица у BPE-токенизаторов заметно дороже латиницы,
+# поэтому берём осторожное значение, чтобы блок гарантированно влезал в контекст
+CHARS_PER_TOKEN = 2.5
+
+_tokenizers: Dict[str, Any] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def _get_tokenizer(model_name: Optional[str]):
+    """Токенизатор модели загружается один раз; при ошибке запоминаем None и считаем оценкой."""
+    if not model_name or not get_llm_use_tokenizer():
+        return None
+    with _tokenizers_lock:
+        if model_name not in _tokenizers:
+            try:
+                from transformers import AutoTokenizer
+                _tokenizers[model_name] = AutoTokenizer.from_pretrained(model_name, token=get_hf_token())
+            except Exception as e:
+                print(f"[token_budget] tokenizer for {model_name} unavailable, using estimate: {e}")
+                _tokenizers[model_name] = None
+        return _tokenizers[model_name]
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def count_tokens(text: str, model_name: Optional[str] = None) -> int:
+    tokenizer = _get_tokenizer(model_name)
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def context_window(model_name: str) -> int:
+    return (get_llm_model_entry(model_name) or {}).get('context_window', DEFAULT_CONTEXT_WINDOW)
+
+
+def response_token_limit(model_name: str, max_tokens: int) -> int:
+    """
+    max_tokens, урезанный под контекст модели: на промпт должно остаться
+    не меньше MIN_PROMPT_BUDGET токенов (у маленьких моделей контекст бывает меньше max_tokens).
+    """
+    return max(1, min(max_tokens, context_window(model_name) - MIN_PROMPT_BUDGET))
+
+
+def clamp_max_tokens(model_name: str, max_tokens: int, owner: str) -> int:
+    """
+    response_token_limit для анализаторов: ответ не должен занимать весь контекст модели,
+    иначе промпт в него не поместится. Урезание логируется от имени owner.
+    """
+    limit = response_token_limit(model_name, max_tokens)
+    if limit < max_tokens:
+        print(f"[{owner}] max_tokens {max_tokens} exceeds context of {model_name}, using {limit}")
+    return limit
+
+
+def prompt_budget(model_name: str, max_tokens: int, reserved_tokens: int = 0) -> int:
+    """
+    Сколько токенов текста слайдов помещается в один запрос:
+    контекст модели (context_window из llm_models_list) минус ответ (max_tokens)
+    и служебная часть промпта, но не больше LLM_PROMPT_TOKEN_BUDGET.
+    """
+    max_tokens = response_token_limit(model_name, max_tokens)
+    budget = context_window(model_name) - max_tokens - reserved_tokens
+    cap = get_llm_prompt_token_budget()
+    if cap:
+        budget = min(budget, cap)
+    return max(budget, MIN_PROMPT_BUDGET)
+
+
+def pack_by_budget(texts: List[str], budget: int, model_name: Optional[str] = None,
+                   separator_tokens: int = 2) -> List[List[int]]:
+    """
+    Жадно упаковывает идущие подряд тексты в группы, суммарно не превышающие budget токенов.
+    Текст никогда не разрезается: слишком длинный текст попадает в отдельную группу.
+    Для непрерывного разбиения жадная упаковка даёт минимальное число групп.
+    Возвращает списки индексов текстов.
+    """
+    groups: List[List[int]] = []
+    current: List[int] = []
+    used = 0
+    for i, text in enumerate(texts):
+        cost = count_tokens(text, model_name) + separator_tokens
+        if current and used + cost > budget:
+            groups.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += cost
+    if current:
+        groups.append(current)
+    return groups
@@ -0,0 +1,315 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессной блокировки нет, индекс — только для одного процесса
+    fcntl = None
+
+PointId = Union[int, str]
+
+INITIAL_CAPACITY = 1024
+KMEANS_ITERATIONS = 10
+# как в faiss: меньше ~40 векторов на список — кластеры обучаются плохо, ищем точно
+MIN_POINTS_PER_LIST = 39
+TRAIN_SAMPLE_PER_LIST = 256
+# журнал переписывается, когда устаревших строк (перезаписанные id) больше, чем живых
+COMPACT_MIN_LINES = 10000
+COMPACT_RATIO = 2
+
+
+class QdrantStore:
+    """Коллекция в Qdrant (удалённый сервис)."""
+
+    def __init__(self, collection_name: str, dim: int, url: str, api_key: str):
+        from qdrant_client import QdrantClient
+        from qdrant_client.models import VectorParams, Distance
+
+        self.collection_name = collection_name
+        self.client = QdrantClient(url=url, api_key=api_key)
+        if not self.client.collection_exists(collection_name):
+            self.client.create_collection(
+                collection_name=collection_name,
+                vectors_config=VectorParams(size=dim, distance=Distance.COSINE)
+            )
+
+    def upsert(self, ids: List[PointId], vectors: List[List[float]], texts: List[str]) -> None:
+        from qdrant_client.models import PointStruct
+
+        points = [PointStruct(id=point_id, vector=vec, payload={"text": text})
+                  for point_id, vec, text in zip(ids, vectors, texts)]
+        self.client.upsert(collection_name=self.collection_name, points=points, wait=True)
+
+    def search(self, vector: List[float], top_k: int) -> List[Tuple[str, float]]:
+        result = self.client.query_points(collection_name=self.collection_name, query=vector, limit=top_k)
+        return [(point.payload.get("text", ""), point.score) for point in result.points]
+
+
+class LocalVectorStore:
+    """
+    Локальный индекс без внешнего сервиса: нормированные векторы float32 лежат
+    в memory-mapped файле vectors.f32 (строка = документ), тексты и id — в журнале
+    payload.jsonl (при повторном id строка перезаписывается, побеждает последняя запись).
+    Поиск точный — скалярные произведения со всеми векторами (косинусная близость)
+    и argpartition для top-k. При ivf_lists > 0 и достаточном числе документов
+    векторы разбиваются k-means на ivf_lists списков, и поиск идёт только
+    по nprobe ближайшим спискам (приближённый, но заметно быстрее на больших коллекциях).
+    k-means обучается в фоновом потоке, когда коллекция выросла; до этого поиск точный.
+
+    Каталог могут открывать несколько процессов (воркеры uvicorn): запись идёт под
+    fcntl.flock на файле .lock, и перед выбором номеров строк процесс дочитывает
+    чужие записи из хвоста журнала. Поиск дочитывает хвост без межпроцессной блокировки
+    (в журнал попадают только уже записанные векторы) и считает близости вне блокировок.
+    """
+
+    def __init__(self, directory: str, dim: int, ivf_lists: int = 0, nprobe: int = 8):
+        self.directory = directory
+        self.dim = dim
+        self.ivf_lists = ivf_lists
+        self.nprobe = nprobe
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._payload_path = os.path.join(directory, "payload.jsonl")
+        self._lock = threading.RLock()
+
+        self._texts: List[str] = []
+        self._ids: List[Optional[PointId]] = []
+        self._rows: Dict[PointId, int] = {}
+        self._matrix: Optional[np.memmap] = None
+        self._capacity = 0
+        # сколько байт журнала уже прочитано, его inode (меняется при компакции) и число строк
+        self._journal_offset = 0
+        self._journal_inode: Optional[int] = None
+        self._journal_lines = 0
+
+        # IVF: центроиды, номер списка для каждой строки, размер коллекции при обучении
+        self._centroids: Optional[np.ndarray] = None
+        self._assignments: Optional[np.ndarray] = None
+        self._trained_on = 0
+        self._training = False
+        # строки, записанные во время обучения: после него их списки пересчитываются
+        self._pending_rows: List[int] = []
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, ".lock"), "a+")
+        with self._lock, self._process_lock():
+            self._sync()
+            self._maybe_compact()
+            self._ensure_capacity(max(self.count, 1))
+            self._maybe_train()
+
+    @property
+    def count(self) -> int:
+        return len(self._texts)
+
+    # ---- запись -------------------------------------------------------------
+    def upsert(self, ids: List[PointId], vectors: List[List[float]], texts: List[str]) -> None:
+        data = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        data = data / np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+        with self._lock, self._process_lock():
+            # записи других процессов — до выбора номеров строк, иначе номера совпадут
+            torn = self._sync()
+            rows = []
+            for point_id, text in zip(ids, texts):
+                row = self._rows.get(point_id)
+                if row is None:
+                    row = self._rows[point_id] = len(self._texts)
+                    self._texts.append(text)
+                    self._ids.append(point_id)
+                else:
+                    self._texts[row] = text
+                rows.append(row)
+
+            self._ensure_capacity(len(self._texts))
+            self._matrix[rows] = data
+            self._matrix.flush()
+            # журнал пишется после векторов: строка без записи в журнале при загрузке не учитывается
+            with open(self._payload_path, "a", encoding="utf-8") as f:
+                if torn:
+                    # оборванная строка после сбоя записи — отделяем её, чтобы не испортить нашу
+                    f.write("\n")
+                for point_id, row, text in zip(ids, rows, texts):
+                    f.write(json.dumps({"row": row, "id": point_id, "text": text}, ensure_ascii=False) + "\n")
+            self._journal_offset = os.path.getsize(self._payload_path)
+            self._journal_lines += len(rows) + (1 if torn else 0)
+            self._index_rows(rows)
+            self._maybe_compact()
+        self._maybe_train()
+
+    # ---- поиск --------------------------------------------------------------
+    def search(self, vector: List[float], top_k: int) -> List[Tuple[str, float]]:
+        query = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._sync()
+            # снимок состояния: скалярные произведения считаются уже без блокировки
+            count, matrix, texts = self.count, self._matrix, self._texts
+            centroids, assignments = self._centroids, self._assignments
+        if not count or top_k <= 0:
+            return []
+
+        if centroids is None:
+            scores = matrix[:count] @ query
+            rows = np.arange(count)
+        else:
+            nprobe = max(1, min(self.nprobe, len(centroids)))
+            lists = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+            rows = np.flatnonzero(np.isin(assignments[:count], lists))
+            scores = matrix[rows] @ query
+
+        k = min(top_k, len(rows))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(texts[int(rows[i])], float(scores[i])) for i in best]
+
+    # ---- хранение -----------------------------------------------------------
+    @contextmanager
+    def _process_lock(self):
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _sync(self) -> bool:
+        """
+        Дочитывает из журнала записи, которых этот процесс ещё не видел (свои и чужие).
+        Возвращает True, если журнал кончается оборванной строкой.
+        """
+        try:
+            st = os.stat(self._payload_path)
+        except FileNotFoundError:
+            return False
+        if st.st_ino != self._journal_inode or st.st_size < self._journal_offset:
+            # журнал переписан компакцией (номера строк при этом не меняются) — читаем заново
+            self._texts, self._ids, self._rows = [], [], {}
+            self._journal_offset, self._journal_inode, self._journal_lines = 0, st.st_ino, 0
+        if st.st_size == self._journal_offset:
+            return False
+
+        with open(self._payload_path, "rb") as f:
+            f.seek(self._journal_offset)
+            tail = f.read()
+        complete = tail.rfind(b"\n") + 1
+        added = []
+        for line in tail[:complete].splitlines():
+            self._journal_lines += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # оборванная строка после сбоя записи
+                continue
+            row, point_id = record["row"], record["id"]
+            if row >= self.count:
+                self._texts.extend([""] * (row + 1 - self.count))
+                self._ids.extend([None] * (row + 1 - len(self._ids)))
+            self._texts[row] = record["text"]
+            self._ids[row] = point_id
+            self._rows[point_id] = row
+            added.append(row)
+        self._journal_offset += complete
+
+        if added:
+            self._ensure_capacity(self.count)
+            self._index_rows(added)
+        return complete < len(tail)
+
+    def _maybe_compact(self) -> None:
+        """Переписывает журнал по одной строке на документ (вызывается под блокировкой процесса)."""
+        if self._journal_lines < COMPACT_MIN_LINES or self._journal_lines <= COMPACT_RATIO * len(self._rows):
+            return
+        tmp_path = f"{self._payload_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for row, (point_id, text) in enumerate(zip(self._ids, self._texts)):
+                if point_id is not None:
+                    f.write(json.dumps({"row": row, "id": point_id, "text": text}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self._payload_path)
+        st = os.stat(self._payload_path)
+        self._journal_offset, self._journal_inode, self._journal_lines = st.st_size, st.st_ino, len(self._rows)
+        print(f"[LocalVectorStore] journal compacted to {len(self._rows)} records")
+
+    def _ensure_capacity(self, rows: int) -> None:
+        if self._matrix is not None and rows <= self._capacity:
+            return
+        capacity = max(self._capacity, INITIAL_CAPACITY)
+        while capacity < rows:
+            capacity *= 2
+        with open(self._vectors_path, "ab") as f:
+            # файл мог вырасти в другом процессе — отображаем его целиком
+            capacity = max(capacity, f.tell() // (4 * self.dim))
+            if f.tell() < capacity * self.dim * 4:
+                f.truncate(capacity * self.dim * 4)
+        if self._matrix is not None:
+            # старое отображение остаётся у поисков, которые его уже взяли; файл только растёт
+            self._matrix.flush()
+        self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self._capacity = capacity
+
+    # ---- IVF ----------------------------------------------------------------
+    def _index_rows(self, rows: List[int]) -> None:
+        if self._training:
+            self._pending_rows.extend(rows)
+        if self._assignments is not None:
+            self._assign_rows(rows)
+
+    def _maybe_train(self) -> None:
+        """Запускает обучение k-means в фоне, если коллекция доросла до него или выросла вдвое."""
+        with self._lock:
+            if not self.ivf_lists or self._training or self.count < self.ivf_lists * MIN_POINTS_PER_LIST:
+                return
+            if self._centroids is not None and self.count < 2 * self._trained_on:
+                return
+            self._training = True
+            self._pending_rows = []
+        threading.Thread(target=self._train_ivf, name="ivf-train", daemon=True).start()
+
+    def _train_ivf(self) -> None:
+        try:
+            with self._lock:
+                count, matrix = self.count, self._matrix
+            rng = np.random.default_rng(0)
+            sample_size = min(count, self.ivf_lists * TRAIN_SAMPLE_PER_LIST)
+            sample = np.asarray(matrix[np.sort(rng.choice(count, sample_size, replace=False))])
+            centroids = sample[rng.choice(sample_size, self.ivf_lists, replace=False)]
+            for _ in range(KMEANS_ITERATIONS):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                for i in range(self.ivf_lists):
+                    members = sample[labels == i]
+                    if len(members):
+                        centroids[i] = members.mean(axis=0)
+                # сферический k-means: центроиды нормируются, близость — скалярное произведение
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+            assignments = np.empty(len(matrix), dtype=np.int32)
+            for start in range(0, count, 4096):
+                stop = min(start + 4096, count)
+                assignments[start:stop] = np.argmax(matrix[start:stop] @ centroids.T, axis=1)
+
+            with self._lock:
+                self._centroids, self._assignments, self._trained_on = centroids, assignments, count
+                # строки, добавленные или перезаписанные, пока шло обучение
+                self._assign_rows(sorted(set(self._pending_rows) | set(range(count, self.count))))
+            print(f"[LocalVectorStore] IVF trained on {count} vectors ({self.ivf_lists} lists)")
+        except Exception as e:
+            print(f"[LocalVectorStore] IVF training failed: {e}")
+        finally:
+            with self._lock:
+                self._training = False
+                self._pending_rows = []
+
+    def _assign_rows(self, rows) -> None:
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(self._assignments) < self._capacity:
+            grown = np.empty(self._capacity, dtype=np.int32)
+            grown[:len(self._assignments)] = self._assignments
+            self._assignments = grown
+        for start in range(0, len(rows), 4096):
+            part = rows[start:start + 4096]
+            self._assignments[part] = np.argmax(self._matrix[part] @ self._centroids.T, axis=1)